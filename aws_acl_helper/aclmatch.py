@@ -1,20 +1,79 @@
 import asyncio
 import fnmatch
+import functools
+import re
 
 
 @asyncio.coroutine
-def test(request, metadata):
-    """Return an ACL action (OK, ERR, or BH) by comparing ACL entries against host metadata"""
+def test(request, profile):
+    """Return an ACL action (OK, ERR, or BH) by comparing ACL entries against a host's match profile"""
 
     if not request.client:
         return 'BH', {'log': 'Failed to parse client IP address'}
-    if not metadata:
+    if not profile:
         return 'ERR', {'log': 'Metadata not available for this client'}
     else:
-        for entry in request.acl:
-            if check_acl_entry(entry, metadata):
-                return 'OK', get_user(metadata)
-        return 'ERR', get_user(metadata)
+        pairs = {'user': profile['user']} if profile['user'] else {}
+        if compile_acl(request.acl).match(profile):
+            return 'OK', pairs
+        return 'ERR', pairs
+
+
+def make_profile(metadata):
+    """ Flatten instance or interface metadata into the attributes used for ACL matching
+
+    The profile is computed at sync time so that the listener does not need to walk
+    the full metadata document for every request.
+    """
+    interfaces = get_interfaces(metadata)
+    groups = [group for interface in interfaces for group in interface.get('groups', [])]
+
+    if 'instance_id' in metadata:
+        host_type = 'ec2'
+    elif metadata.get('attachment', {}).get('instance_owner_id', None) == 'aws-lambda':
+        host_type = 'lambda'
+    else:
+        host_type = None
+
+    return {
+        'instance_id': metadata.get('instance_id', None),
+        'image_id': metadata.get('image_id', None),
+        'vpc_id': metadata.get('vpc_id', None),
+        'availability_zone': metadata.get('placement', {}).get('availability_zone', '').lower(),
+        'type': host_type,
+        'interface_ids': frozenset(i['network_interface_id'] for i in interfaces if 'network_interface_id' in i),
+        'subnet_ids': frozenset(i['subnet_id'] for i in interfaces if 'subnet_id' in i),
+        'owner_ids': frozenset(i['owner_id'] for i in interfaces if 'owner_id' in i),
+        'group_ids': frozenset(g['group_id'] for g in groups if 'group_id' in g),
+        'group_names': frozenset(g.get('group_name', '').lower() for g in groups),
+        'tags': {key: value.lower() for key, value in metadata.get('tags', {}).items()},
+        'user': get_user(metadata).get('user', None),
+        'partial': False,
+    }
+
+
+def make_network_profile(network):
+    """ Build a partial match profile for a subnet or VPC
+
+    Used for addresses that fall within a known CIDR block but do not belong to a
+    synced host, so that only network-level ACL entries (subnet, VPC, owner and
+    availability zone) can match.
+    """
+    return {
+        'instance_id': None,
+        'image_id': None,
+        'vpc_id': network.get('vpc_id', None),
+        'availability_zone': network.get('availability_zone', '').lower(),
+        'type': None,
+        'interface_ids': frozenset(),
+        'subnet_ids': frozenset([network['subnet_id']]) if 'subnet_id' in network else frozenset(),
+        'owner_ids': frozenset([network['owner_id']]) if 'owner_id' in network else frozenset(),
+        'group_ids': frozenset(),
+        'group_names': frozenset(),
+        'tags': {},
+        'user': None,
+        'partial': True,
+    }
 
 
 def get_user(metadata):
@@ -38,92 +97,122 @@ def get_user(metadata):
         return {}
 
 
-def check_acl_entry(entry, metadata):
-    """ Check an individual ACL entry against host metadata
+def check_acl_entry(entry, profile):
+    """ Check an individual ACL entry against a host's match profile
 
     Returns True if matched, else False
+    """
+    return compile_acl((entry,)).match(profile)
+
+
+@functools.lru_cache(maxsize=256)
+def compile_acl(acl):
+    """Return a Matcher for a tuple of ACL entries, reusing previously compiled matchers"""
+    return Matcher(acl)
+
+
+def compile_globs(patterns):
+    """Combine a list of shell-style globs into a single case-insensitive regex"""
+    if patterns:
+        return re.compile('|'.join(fnmatch.translate(p.lower()) for p in patterns))
+    return None
+
+
+class Matcher:
+    """ Compiled form of an ACL argument list
+
+    Entries are grouped by kind into sets of exact IDs and combined regexes for
+    glob patterns, so that matching does not need to re-parse the ACL strings.
 
     Supported ACL entry strings:
         * Instance ID (i-xxx)
+        * Network Interface ID (eni-xxx)
         * Security Group ID (sg-xxx)
         * Image AMI ID (ami-xxx)
         * VPC ID (vpc-xxx)
         * Subnet ID (subnet-xxx)
+        * Owner ID (owner:012345678901)
         * Availability zone (az:us-west-2*)          - Matches shell-style globs
         * Security Group Name (sg:my security group) - Matches shell-style globs
         * Tag (tag:Name=Value)                       - Matches shell-style globs
+        * Type (type:ec2 or type:lambda)
         * Existence as an EC2 instance (any)         - Matches if request is from a known EC2 instance
     """
 
-    if entry.startswith('i-'):
-        return entry == metadata.get('instance_id', None)
-
-    elif entry.startswith('eni-'):
-        for interface in get_interfaces(metadata):
-            if entry == interface.get('network_interface_id'):
-                return True
-        return False
-
-    elif entry.startswith('sg-'):
-        for interface in get_interfaces(metadata):
-            for group in interface.get('groups', []):
-                if entry == group.get('group_id'):
-                    return True
-        return False
-
-    elif entry.startswith('ami-'):
-        return entry == metadata.get('image_id', None)
-
-    elif entry.startswith('vpc-'):
-        return entry == metadata.get('vpc_id', None)
-
-    elif entry.startswith('subnet-'):
-        for interface in get_interfaces(metadata):
-            if entry == interface.get('subnet_id'):
-                return True
-        return False
-
-    elif entry.startswith('owner:'):
-        owner_id = entry[6:].lower()
-        for interface in get_interfaces(metadata):
-            if owner_id == interface.get('owner_id'):
-                return True
-        return False
-
-    elif entry.startswith('az:'):
-        pattern = entry[3:].lower()
-        return fnmatch.fnmatch(metadata.get('placement', {}).get('availability_zone', '').lower(), pattern)
-
-    elif entry.startswith('sg:'):
-        pattern = entry[3:].lower()
-        for interface in get_interfaces(metadata):
-            for group in interface.get('groups', []):
-                if fnmatch.fnmatch(group.get('group_name', '').lower(), pattern):
+    def __init__(self, acl):
+        self.any = False
+        self.instance_ids = set()
+        self.interface_ids = set()
+        self.group_ids = set()
+        self.image_ids = set()
+        self.vpc_ids = set()
+        self.subnet_ids = set()
+        self.owner_ids = set()
+        self.types = set()
+        az_patterns = []
+        group_patterns = []
+        tag_patterns = {}
+
+        for entry in acl:
+            if entry.startswith('i-'):
+                self.instance_ids.add(entry)
+            elif entry.startswith('eni-'):
+                self.interface_ids.add(entry)
+            elif entry.startswith('sg-'):
+                self.group_ids.add(entry)
+            elif entry.startswith('ami-'):
+                self.image_ids.add(entry)
+            elif entry.startswith('vpc-'):
+                self.vpc_ids.add(entry)
+            elif entry.startswith('subnet-'):
+                self.subnet_ids.add(entry)
+            elif entry.startswith('owner:'):
+                self.owner_ids.add(entry[6:].lower())
+            elif entry.startswith('az:'):
+                az_patterns.append(entry[3:])
+            elif entry.startswith('sg:'):
+                group_patterns.append(entry[3:])
+            elif entry.startswith('tag:'):
+                if '=' in entry:
+                    key, pattern = entry[4:].split('=', 1)
+                    tag_patterns.setdefault(key, []).append(pattern)
+            elif entry.startswith('type:'):
+                self.types.add(entry[5:].lower())
+            elif entry == 'any':
+                self.any = True
+
+        self.az_regex = compile_globs(az_patterns)
+        self.group_regex = compile_globs(group_patterns)
+        self.tag_regexes = [(key, compile_globs(patterns)) for key, patterns in tag_patterns.items()]
+
+    def match(self, profile):
+        """Return True if any entry in the ACL matches the host's match profile"""
+        if self.any and not profile.get('partial', False):
+            return True
+
+        if profile['instance_id'] in self.instance_ids or profile['image_id'] in self.image_ids or profile['vpc_id'] in self.vpc_ids:
+            return True
+
+        if profile['type'] in self.types:
+            return True
+
+        if not (self.interface_ids.isdisjoint(profile['interface_ids']) and self.group_ids.isdisjoint(profile['group_ids']) and
+                self.subnet_ids.isdisjoint(profile['subnet_ids']) and self.owner_ids.isdisjoint(profile['owner_ids'])):
+            return True
+
+        if self.az_regex and self.az_regex.match(profile['availability_zone']):
+            return True
+
+        if self.group_regex:
+            for name in profile['group_names']:
+                if self.group_regex.match(name):
                     return True
-        return False
 
-    elif entry.startswith('tag:'):
-        pattern = entry[4:]
-        key, pattern = pattern.split('=', 1)
-        pattern = pattern.lower()
-        if key in metadata.get('tags', {}):
-            if fnmatch.fnmatch(metadata['tags'][key].lower(), pattern):
+        tags = profile['tags']
+        for key, regex in self.tag_regexes:
+            if key in tags and regex.match(tags[key]):
                 return True
-        return False
-
-    elif entry.startswith('type:'):
-        meta_type = entry[5:].lower()
-        if meta_type == 'ec2':
-            return 'instance_id' in metadata
-        elif meta_type == 'lambda':
-            return metadata.get('attachment', {}).get('instance_owner_id', None) == 'aws-lambda'
-        else:
-            return False
 
-    elif entry == 'any':
-        return True
-
-    else:
         return False
 
 
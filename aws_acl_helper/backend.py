@@ -0,0 +1,252 @@
+import asyncio
+import binascii
+import itertools
+import logging
+
+import aioredis
+
+logger = logging.getLogger(__name__)
+
+# Number of hash slots in a Redis Cluster
+CLUSTER_SLOTS = 16384
+
+
+def connect(config, readonly=False):
+    """ Return a backend for the Redis deployment described by a configuration
+
+    Readers pass readonly=True, which allows lookups to be spread across replicas;
+    writers always use the primary.
+    """
+    if config.sentinels:
+        return SentinelBackend(config, readonly)
+    if config.cluster:
+        return ClusterBackend(config, readonly)
+    return RedisBackend(config, readonly)
+
+
+def command_key(command):
+    """Return the key that a single-key command operates on"""
+    if command[0].upper() in ('EVAL', 'EVALSHA'):
+        return command[3]
+    return command[1]
+
+
+def parse_address(address):
+    """Split a HOST:PORT string into a (host, port) tuple, defaulting to the standard Redis port"""
+    host, _, port = address.rpartition(':')
+    if not host:
+        return (port, 6379)
+    return (host, int(port))
+
+
+class RedisBackend(object):
+    """ Standalone Redis server, optionally with read-only replicas
+
+    Commands are sent with execute_many, which pipelines a batch of single-key
+    commands and returns their results (or exceptions) in order. Keeping to
+    single-key commands means that the same code works against clusters.
+    """
+    def __init__(self, config, readonly=False):
+        self.config = config
+        self.readonly = readonly
+        self.primary = None
+        self.replicas = []
+        self.readers = None
+
+    async def connect(self):
+        self.primary = await self.create_pool((self.config.redis_host, self.config.redis_port))
+        if self.readonly:
+            self.replicas = [await self.create_pool(parse_address(address)) for address in self.config.replicas]
+        self.readers = itertools.cycle(self.replicas or [self.primary])
+
+    async def create_pool(self, address):
+        return await aioredis.create_pool(address, minsize=1, maxsize=self.config.workers)
+
+    async def close(self):
+        for pool in [self.primary] + self.replicas:
+            if pool is not None:
+                pool.close()
+                await pool.wait_closed()
+        self.primary = None
+        self.replicas = []
+
+    def target(self, readonly):
+        return next(self.readers) if readonly and self.readonly else self.primary
+
+    async def execute(self, *command, readonly=False):
+        return await self.target(readonly).execute(*command)
+
+    async def execute_many(self, commands, readonly=False):
+        target = self.target(readonly)
+        return await asyncio.gather(*[target.execute(*command) for command in commands], return_exceptions=True)
+
+
+class SentinelBackend(RedisBackend):
+    """Redis primary and replicas discovered through Sentinel, following failovers"""
+    def __init__(self, config, readonly=False):
+        super().__init__(config, readonly)
+        self.sentinel = None
+
+    async def connect(self):
+        sentinels = [parse_address(address) for address in self.config.sentinels]
+        self.sentinel = await aioredis.create_sentinel(sentinels, maxsize=self.config.workers)
+        self.primary = self.sentinel.master_for(self.config.service_name)
+        if self.readonly and self.config.read_from_replica:
+            self.replicas = [self.sentinel.slave_for(self.config.service_name)]
+        self.readers = itertools.cycle(self.replicas or [self.primary])
+
+    async def close(self):
+        if self.sentinel is not None:
+            self.sentinel.close()
+            await self.sentinel.wait_closed()
+            self.sentinel = None
+        self.primary = None
+        self.replicas = []
+
+
+class ClusterBackend(object):
+    """ Redis Cluster, routing each command to the node that serves its key's hash slot
+
+    The slot map is loaded from CLUSTER SLOTS, and reloaded when a node answers
+    with a MOVED redirection. A command redirected with ASK, because its slot is
+    being migrated, is sent once to the node named in the reply, after ASKING,
+    without changing the slot map. Readers send commands to replicas when
+    read_from_replica is enabled.
+    """
+    def __init__(self, config, readonly=False):
+        self.config = config
+        self.readonly = readonly and config.read_from_replica
+        self.connections = {}
+        self.slots = []
+        self.readers = {}
+
+    async def connect(self):
+        await self.load_slots([(self.config.redis_host, self.config.redis_port)])
+
+    async def close(self):
+        for conn in self.connections.values():
+            conn.close()
+            await conn.wait_closed()
+        self.connections = {}
+
+    async def connection(self, address):
+        """Return a connection to a cluster node, reconnecting if it has been closed"""
+        conn = self.connections.get(address)
+        if conn is None or conn.closed:
+            conn = await aioredis.create_connection(address)
+            if self.readonly:
+                await conn.execute('READONLY')
+            self.connections[address] = conn
+        return conn
+
+    async def load_slots(self, addresses=None):
+        """Load the mapping of hash slots to primary and replica nodes from the first node that responds"""
+        if addresses is None:
+            addresses = list(self.connections) + [(self.config.redis_host, self.config.redis_port)]
+
+        for address in addresses:
+            try:
+                conn = await self.connection(address)
+                ranges = await conn.execute('CLUSTER', 'SLOTS')
+                break
+            except (OSError, aioredis.RedisError) as e:
+                logger.warning(f'Unable to load cluster slots from {address}: {e}')
+        else:
+            raise aioredis.RedisError('Unable to load cluster slots from any node')
+
+        slots = [None] * CLUSTER_SLOTS
+        readers = {}
+        for start, end, primary, *replicas in ranges:
+            nodes = (node_address(primary), [node_address(replica) for replica in replicas])
+            readers[nodes[0]] = itertools.cycle(nodes[1] or [nodes[0]])
+            for slot in range(start, end + 1):
+                slots[slot] = nodes
+        self.slots = slots
+        self.readers = readers
+        logger.debug(f'Loaded cluster slots for {len(readers)} primaries')
+
+    def target(self, key, readonly):
+        primary, replicas = self.slots[key_slot(key)]
+        if readonly and self.readonly:
+            return next(self.readers[primary])
+        return primary
+
+    async def execute(self, *command, readonly=False):
+        result = (await self.execute_many([command], readonly))[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    async def execute_many(self, commands, readonly=False):
+        results = [None] * len(commands)
+        pending = list(range(len(commands)))
+        groups = {}
+        for index in pending:
+            groups.setdefault((self.target(command_key(commands[index]), readonly), False), []).append(index)
+
+        for attempt in range(2):
+            await asyncio.gather(*[self.execute_on(address, [(index, commands[index]) for index in indexes], results, asking)
+                                   for (address, asking), indexes in groups.items()])
+
+            # Retry redirected commands: MOVED means that the slot map is out of date, while ASK
+            # only applies to the one command, during a migration
+            pending = [index for index in pending if is_redirect(results[index])]
+            if not pending or attempt:
+                break
+            if any(str(results[index]).startswith('MOVED') for index in pending):
+                await self.load_slots()
+
+            groups = {}
+            for index in pending:
+                if str(results[index]).startswith('ASK'):
+                    target = (redirect_address(results[index]), True)
+                else:
+                    target = (self.target(command_key(commands[index]), readonly), False)
+                groups.setdefault(target, []).append(index)
+
+        return results
+
+    async def execute_on(self, address, indexed_commands, results, asking=False):
+        try:
+            conn = await self.connection(address)
+            # Commands are written to the connection in order, so each ASKING applies to the command that follows it
+            futures = []
+            for _, command in indexed_commands:
+                if asking:
+                    futures.append(conn.execute('ASKING'))
+                futures.append(conn.execute(*command))
+            replies = await asyncio.gather(*futures, return_exceptions=True)
+            if asking:
+                replies = replies[1::2]
+        except Exception as e:
+            replies = [e] * len(indexed_commands)
+        for (index, _), reply in zip(indexed_commands, replies):
+            results[index] = reply
+
+
+def node_address(node):
+    host, port = node[0], node[1]
+    return (host.decode() if isinstance(host, bytes) else host, int(port))
+
+
+def is_redirect(result):
+    return isinstance(result, aioredis.ReplyError) and str(result).startswith(('MOVED', 'ASK'))
+
+
+def redirect_address(result):
+    """Return the address of the node named in a MOVED or ASK reply, such as 'ASK 3999 127.0.0.1:6381'"""
+    host, port = str(result).split()[2].rsplit(':', 1)
+    return (host, int(port))
+
+
+def key_slot(key):
+    """Return the cluster hash slot for a key, honouring {hash tags}"""
+    if isinstance(key, str):
+        key = key.encode()
+    start = key.find(b'{')
+    if start != -1:
+        end = key.find(b'}', start + 1)
+        if end > start + 1:
+            key = key[start + 1:end]
+    # CRC-CCITT (XMODEM) as used by Redis Cluster
+    return binascii.crc_hqx(key, 0) % CLUSTER_SLOTS
@@ -0,0 +1,83 @@
+import hashlib
+import math
+
+
+class BloomFilter(object):
+    """ Compact probabilistic set of byte strings, with no false negatives
+
+    Each key sets a fixed number of bits chosen by enhanced double hashing of a
+    single digest, so a key whose bits are not all set has definitely never been
+    added. The extra term keeps small filters close to their intended false
+    positive rate, which plain double hashing overshoots.
+    """
+    def __init__(self, size, hashes, bits=None):
+        self.size = size
+        self.hashes = hashes
+        self.bits = bytearray(bits) if bits is not None else bytearray((size + 7) // 8)
+
+    @classmethod
+    def for_capacity(cls, capacity, error_rate=0.01):
+        """Return an empty filter sized to hold capacity keys with the given false positive rate"""
+        capacity = max(capacity, 1)
+        size = max(int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)), 8)
+        hashes = max(int(round(size / capacity * math.log(2))), 1)
+        return cls(size, hashes)
+
+    def positions(self, key):
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'big')
+        second = int.from_bytes(digest[8:], 'big') | 1
+        positions = []
+        for i in range(self.hashes):
+            positions.append(first % self.size)
+            first += second
+            second += i
+        return positions
+
+    def add(self, key):
+        for position in self.positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self.positions(key))
+
+
+class CountingBloomFilter(BloomFilter):
+    """ Bloom filter that keys can be removed from as well as added to
+
+    Each position holds a count of the keys that set it rather than a single bit.
+    A count that reaches the maximum is never decremented again, so removing keys
+    can not cause false negatives.
+    """
+    def __init__(self, size, hashes, counts=None, capacity=0):
+        self.size = size
+        self.hashes = hashes
+        self.counts = bytearray(counts) if counts is not None else bytearray(size)
+        self.capacity = capacity
+
+    @classmethod
+    def for_capacity(cls, capacity, error_rate=0.01):
+        bloom = super().for_capacity(capacity, error_rate)
+        bloom.capacity = capacity
+        return bloom
+
+    def copy(self):
+        return type(self)(self.size, self.hashes, self.counts, self.capacity)
+
+    def add(self, key):
+        counts = self.counts
+        for position in self.positions(key):
+            if counts[position] < 255:
+                counts[position] += 1
+
+    def remove(self, key):
+        """Remove a key that was previously added"""
+        counts = self.counts
+        for position in self.positions(key):
+            if counts[position] < 255:
+                counts[position] -= 1
+
+    def __contains__(self, key):
+        counts = self.counts
+        return all(counts[position] for position in self.positions(key))
@@ -0,0 +1,53 @@
+import time
+from collections import OrderedDict
+
+from .metrics import Counter
+
+CACHE_REQUESTS = Counter('aws_acl_helper_cache_requests_total', 'In-memory cache lookups, by cache and result.', ['cache', 'result'])
+
+
+class LRUCache(object):
+    """Size-bounded least-recently-used cache with per-entry expiration"""
+
+    def __init__(self, maxsize=4096, ttl=60, name='default'):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.name = name
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        """Return the cached value for key, or default if missing or expired"""
+        try:
+            expires, value = self._data[key]
+        except KeyError:
+            CACHE_REQUESTS.inc(self.name, 'miss')
+            return default
+
+        if expires < time.monotonic():
+            del self._data[key]
+            CACHE_REQUESTS.inc(self.name, 'miss')
+            return default
+
+        self._data.move_to_end(key)
+        CACHE_REQUESTS.inc(self.name, 'hit')
+        return value
+
+    def set(self, key, value, ttl=None):
+        """Store a value, evicting the least recently used entries if over capacity"""
+        if self.maxsize <= 0:
+            return
+
+        if ttl is None:
+            ttl = self.ttl
+
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
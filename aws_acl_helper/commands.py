@@ -1,17 +1,53 @@
+import importlib
+
 import click
-from pkg_resources import get_distribution
 
-from . import listen, sync
+# Subcommands, and the module and attribute that each is defined in. Modules are only
+# imported when their command is used, so that starting a listener for Squid does not
+# have to wait for the AWS SDK to load.
+COMMANDS = {
+    'listen': ('.listen', 'listen'),
+    'sync': ('.sync', 'sync'),
+    'sync-multi': ('.sync', 'sync_multi'),
+    'sync-daemon': ('.sync', 'sync_daemon'),
+}
+
+
+class LazyGroup(click.Group):
+    """Click group that imports the module for a subcommand only when that subcommand is requested"""
+    def __init__(self, *args, lazy_commands=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lazy_commands = lazy_commands or {}
+
+    def list_commands(self, ctx):
+        return sorted(set(super().list_commands(ctx)).union(self.lazy_commands))
+
+    def get_command(self, ctx, name):
+        if name in self.lazy_commands and name not in self.commands:
+            module_name, attribute = self.lazy_commands[name]
+            module = importlib.import_module(module_name, __package__)
+            self.add_command(getattr(module, attribute), name)
+        return super().get_command(ctx, name)
+
+
+def get_version():
+    distribution = __package__
+    try:
+        from importlib.metadata import version
+    except ImportError:
+        from pkg_resources import get_distribution
+        return get_distribution(distribution).version
+    return version(distribution)
 
 
 def _print_version(ctx, param, value):
     if not value or ctx.resilient_parsing:
         return
-    click.echo(get_distribution(__name__.split('.')[0]).version)
+    click.echo(get_version())
     ctx.exit()
 
 
-@click.group()
+@click.group(cls=LazyGroup, lazy_commands=COMMANDS)
 @click.option(
     '--version',
     is_flag=True,
@@ -24,9 +60,5 @@ def cli():
     pass
 
 
-cli.add_command(listen.listen)
-cli.add_command(sync.sync)
-cli.add_command(sync.sync_multi)
-
 if __name__ == '__main__':
     cli()
@@ -4,27 +4,102 @@ from backports import configparser
 def parse_file(filename):
     config = configparser.ConfigParser()
     config.read(filename)
-    return [Config(**config[s]) for s in config.sections()]
+    return [Config(name=s, **config[s]) for s in config.sections()]
+
+
+def split_list(value):
+    """Split a comma or whitespace separated string from a configuration file into a list"""
+    if isinstance(value, str):
+        return value.replace(',', ' ').split()
+    return list(value)
+
+
+def parse_filters(value):
+    """ Convert NAME=VALUE[,VALUE...] strings into a list of EC2 API filters
+
+    A string from a configuration file may hold several filters, one per line.
+    """
+    if isinstance(value, str):
+        value = value.splitlines()
+    filters = []
+    for item in value:
+        name, _, values = item.strip().partition('=')
+        if name:
+            filters.append({'Name': name, 'Values': values.split(',')})
+    return filters
+
+
+def parse_bool(value):
+    """Convert a boolean option, which may be a string from a configuration file"""
+    if isinstance(value, str):
+        return value.lower() in ('1', 'yes', 'true', 'on')
+    return bool(value)
 
 
 class Config:
     """Configuration object to store command-line options or defaults"""
+    _name = 'default'
     _redis_host = 'localhost'
     _redis_port = 6379
     _redis_ttl = 1800
+    _codec = 'msgpack'
+    _layout = 'inline'
+    _chunk_size = 500
+    _page_size = 1000
+    _instance_filters = ()
+    _interface_filters = ()
     _profile_name = None
     _region_name = None
     _role_arn = None
     _external_id = None
+    _credential_cache = None
+    _parallelism = 4
+    _interval = None
+    _cache_size = 4096
+    _cache_ttl = 60
+    _negative_cache_ttl = 10
+    _network_fallback = False
+    _batch_window = 1.0
+    _snapshot = None
+    _workers = 20
+    _queue_size = 1000
+    _decision_cache_size = 16384
+    _decision_cache_ttl = 60
+    _metrics_socket = None
+    _replicas = ()
+    _sentinels = ()
+    _service_name = 'mymaster'
+    _cluster = False
+    _read_from_replica = False
     _debug = False
 
-    def __init__(self, host=None, port=None, ttl=None, profile=None, region=None, role_arn=None, external_id=None, debug=False):
+    def __init__(self, name=None, host=None, port=None, ttl=None, codec=None, layout=None, chunk_size=None, page_size=None,
+                 instance_filter=None, interface_filter=None, profile=None, region=None, role_arn=None,
+                 external_id=None, credential_cache=None, parallelism=None, interval=None, cache_size=None, cache_ttl=None,
+                 negative_cache_ttl=None, network_fallback=False, batch_window=None, snapshot=None, workers=None, queue_size=None,
+                 decision_cache_size=None, decision_cache_ttl=None,
+                 metrics_socket=None, replica=None, sentinel=None, service_name=None, cluster=False,
+                 read_from_replica=False, debug=False):
+        if name is not None:
+            self._name = name
         if host is not None:
             self._redis_host = host
         if port is not None:
             self._redis_port = port
         if ttl is not None:
             self._redis_ttl = ttl
+        if codec is not None:
+            self._codec = codec
+        if layout is not None:
+            self._layout = layout
+        if chunk_size is not None:
+            self._chunk_size = chunk_size
+        if page_size is not None:
+            self._page_size = page_size
+        if instance_filter:
+            self._instance_filters = instance_filter
+        if interface_filter:
+            self._interface_filters = interface_filter
         if profile is not None:
             self._profile_name = profile
         if region is not None:
@@ -33,9 +108,52 @@ class Config:
             self._role_arn = role_arn
         if external_id is not None:
             self._external_id = external_id
+        if credential_cache is not None:
+            self._credential_cache = credential_cache
+        if parallelism is not None:
+            self._parallelism = parallelism
+        if interval is not None:
+            self._interval = interval
+        if cache_size is not None:
+            self._cache_size = cache_size
+        if cache_ttl is not None:
+            self._cache_ttl = cache_ttl
+        if negative_cache_ttl is not None:
+            self._negative_cache_ttl = negative_cache_ttl
+        if network_fallback is not False:
+            self._network_fallback = network_fallback
+        if batch_window is not None:
+            self._batch_window = batch_window
+        if snapshot is not None:
+            self._snapshot = snapshot
+        if workers is not None:
+            self._workers = workers
+        if queue_size is not None:
+            self._queue_size = queue_size
+        if decision_cache_size is not None:
+            self._decision_cache_size = decision_cache_size
+        if decision_cache_ttl is not None:
+            self._decision_cache_ttl = decision_cache_ttl
+        if metrics_socket is not None:
+            self._metrics_socket = metrics_socket
+        if replica:
+            self._replicas = replica
+        if sentinel:
+            self._sentinels = sentinel
+        if service_name is not None:
+            self._service_name = service_name
+        if cluster is not False:
+            self._cluster = cluster
+        if read_from_replica is not False:
+            self._read_from_replica = read_from_replica
         if debug is not False:
             self._debug = True
 
+    @property
+    def name(self):
+        """Name of the configuration file section"""
+        return self._name
+
     @property
     def redis_host(self):
         """Hostname or address of Redis server"""
@@ -51,6 +169,36 @@ class Config:
         """Expiration time for AWS metadata stored in Redis"""
         return self._redis_ttl
 
+    @property
+    def codec(self):
+        """Serialization format for AWS metadata stored in Redis"""
+        return self._codec
+
+    @property
+    def layout(self):
+        """Layout of lookup keys stored in Redis"""
+        return self._layout
+
+    @property
+    def chunk_size(self):
+        """Number of objects to send to Redis in each pipelined write"""
+        return int(self._chunk_size)
+
+    @property
+    def page_size(self):
+        """Number of instances or interfaces to request from the EC2 API in each page"""
+        return int(self._page_size)
+
+    @property
+    def instance_filters(self):
+        """EC2 API filters applied when describing instances"""
+        return parse_filters(self._instance_filters)
+
+    @property
+    def interface_filters(self):
+        """EC2 API filters applied when describing network interfaces"""
+        return parse_filters(self._interface_filters)
+
     @property
     def profile_name(self):
         """AWS Configuration Profile name"""
@@ -71,6 +219,103 @@ class Config:
         """External ID for AssumeRole call"""
         return self._external_id
 
+    @property
+    def credential_cache(self):
+        """Path to file to cache assumed role credentials in"""
+        return self._credential_cache
+
+    @property
+    def parallelism(self):
+        """Maximum number of regions to sync concurrently for this account"""
+        return int(self._parallelism)
+
+    @property
+    def interval(self):
+        """Time between syncs when running as a daemon; defaults to half the metadata TTL"""
+        if self._interval is None:
+            return int(self.redis_ttl) / 2
+        return float(self._interval)
+
+    @property
+    def cache_size(self):
+        """Maximum number of host metadata entries cached in memory by the listener"""
+        return int(self._cache_size)
+
+    @property
+    def cache_ttl(self):
+        """Expiration time for host metadata cached in memory by the listener"""
+        return int(self._cache_ttl)
+
+    @property
+    def negative_cache_ttl(self):
+        """Expiration time for unknown addresses cached in memory by the listener"""
+        return int(self._negative_cache_ttl)
+
+    @property
+    def network_fallback(self):
+        """Whether to match unknown addresses against the subnet or VPC containing them"""
+        return parse_bool(self._network_fallback)
+
+    @property
+    def batch_window(self):
+        """Time in milliseconds to wait for additional lookups before sending a batch to Redis"""
+        return float(self._batch_window)
+
+    @property
+    def snapshot(self):
+        """Path to snapshot file of host match profiles"""
+        return self._snapshot
+
+    @property
+    def workers(self):
+        """Number of requests processed concurrently by the listener, and size of its Redis connection pool"""
+        return int(self._workers)
+
+    @property
+    def queue_size(self):
+        """Maximum number of requests waiting for a worker before the listener stops reading from Squid"""
+        return int(self._queue_size)
+
+    @property
+    def decision_cache_size(self):
+        """Maximum number of client and ACL pairs to cache responses for in memory"""
+        return int(self._decision_cache_size)
+
+    @property
+    def decision_cache_ttl(self):
+        """Time-to-live for ACL responses cached in memory"""
+        return int(self._decision_cache_ttl)
+
+    @property
+    def metrics_socket(self):
+        """Path to Unix socket to serve metrics on"""
+        return self._metrics_socket
+
+    @property
+    def replicas(self):
+        """List of HOST:PORT addresses of read-only Redis replicas"""
+        return split_list(self._replicas)
+
+    @property
+    def sentinels(self):
+        """List of HOST:PORT addresses of Redis Sentinels"""
+        return split_list(self._sentinels)
+
+    @property
+    def service_name(self):
+        """Name of the Redis primary monitored by Sentinel"""
+        return self._service_name
+
+    @property
+    def cluster(self):
+        """Whether the Redis server is part of a Redis Cluster"""
+        return parse_bool(self._cluster)
+
+    @property
+    def read_from_replica(self):
+        """Whether to send lookups to replicas discovered through Sentinel or Redis Cluster"""
+        return parse_bool(self._read_from_replica)
+
     @property
     def debug_enabled(self):
         """Debug Flag Status"""
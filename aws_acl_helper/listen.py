@@ -6,17 +6,30 @@ import os
 import socket
 import stat
 import sys
+import time
 from asyncio.streams import FlowControlMixin, StreamWriter
 
 import click
 
-from . import aclmatch, squid
+from . import aclmatch, metrics, squid
+from .cache import LRUCache
 from .config import Config
-from .metadata import RedisMetadataReader
+from .metadata import LAYOUTS, RedisMetadataReader
+from .snapshot import SnapshotMetadataReader
 
-reader, writer = None, None
+reader, writer, responses, decisions = None, None, None, None
 logger = logging.getLogger(__name__)
 
+# Maximum number of bytes to read from Squid at once
+READ_SIZE = 65536
+
+REQUESTS = metrics.Counter('aws_acl_helper_requests_total', 'ACL lookup requests handled, by result.', ['result'])
+PARSE_SECONDS = metrics.Histogram('aws_acl_helper_parse_seconds', 'Time taken to parse a request from Squid.')
+LOOKUP_SECONDS = metrics.Histogram('aws_acl_helper_lookup_seconds', 'Time taken to look up metadata for a client.')
+MATCH_SECONDS = metrics.Histogram('aws_acl_helper_match_seconds', 'Time taken to match client metadata against an ACL.')
+QUEUE_WAIT_SECONDS = metrics.Histogram('aws_acl_helper_queue_wait_seconds', 'Time requests spent waiting for a worker.')
+QUEUE_DEPTH = metrics.Gauge('aws_acl_helper_queue_depth', 'Number of requests waiting for a worker.')
+
 
 def squid_inherited_socket():
     """Detect socket passed from squid via fds 0 and 1"""
@@ -57,11 +70,61 @@ async def accept_socket(sock, loop=None):
     return reader, writer
 
 
+class ResponseBuffer(object):
+    """Collect response lines and write them to Squid with a single call per event loop iteration"""
+    def __init__(self, writer):
+        self.writer = writer
+        self.lines = []
+
+    def write(self, line):
+        if not self.lines:
+            asyncio.get_event_loop().call_soon(self.flush)
+        self.lines.append(line)
+
+    def flush(self):
+        lines, self.lines = self.lines, []
+        self.writer.write(b''.join(lines))
+
+
+class DecisionCache(object):
+    """ Encoded responses for (client, ACL) pairs, discarded whenever the sync generation changes
+
+    Squid caches helper responses per ACL, but each helper child and each distinct
+    ACL would otherwise still look up and match the same client over and over.
+    """
+    def __init__(self, maxsize, ttl):
+        self.cache = LRUCache(maxsize=maxsize, ttl=ttl, name='decision')
+        self.generation = None
+
+    def get(self, key, generation):
+        if generation != self.generation:
+            self.cache.clear()
+            self.generation = generation
+        return self.cache.get(key)
+
+    def set(self, key, decision, generation):
+        # Don't cache decisions made against metadata from a previous sync
+        if generation == self.generation:
+            self.cache.set(key, decision)
+
+
+async def worker(metadata, queue):
+    """Process request lines from the queue until cancelled"""
+    while True:
+        queued, line = await queue.get()
+        QUEUE_WAIT_SECONDS.observe(time.monotonic() - queued)
+        try:
+            await handle_line(metadata, line)
+        finally:
+            queue.task_done()
+
+
 async def async_input(config):
     """Handle reading lines from stdin and handing off to background task for processing"""
     loop = asyncio.get_event_loop()
 
-    global reader, writer
+    global reader, writer, responses, decisions
+    decisions = DecisionCache(config.decision_cache_size, config.decision_cache_ttl)
     if (reader, writer) == (None, None):
         sock = squid_inherited_socket()
         if sock:
@@ -69,36 +132,82 @@ async def async_input(config):
         else:
             logger.warn('aws-acl-helper did not detect squid socket, using stdio. See brandond/aws-acl-helper#2')
             reader, writer = await stdio()
+        responses = ResponseBuffer(writer)
 
-    async with RedisMetadataReader(config) as metadata:
-        while True:
-            line = await reader.readline()
-            logger.debug(f'STDIN: {line}')
+    servers = await metrics.start_server(path=config.metrics_socket)
+    reader_class = SnapshotMetadataReader if config.snapshot else RedisMetadataReader
+    async with reader_class(config) as metadata:
+        # Requests are handled by a fixed pool of workers; once the queue is full,
+        # reading from Squid stops until the workers catch up.
+        queue = asyncio.Queue(maxsize=config.queue_size)
+        QUEUE_DEPTH.set_function(queue.qsize)
+        workers = [loop.create_task(worker(metadata, queue)) for _ in range(config.workers)]
+        try:
+            await read_requests(queue)
+            await queue.join()
+        finally:
+            for task in workers:
+                task.cancel()
+            await metrics.stop_server(servers)
 
-            # Readline returns empty bystes string when the socket is closed
-            if line == b'':
+
+async def read_requests(queue):
+    """Read request lines from Squid and add them to the work queue"""
+    partial = b''
+    while True:
+        # Read everything that Squid has sent so far, and split it into lines
+        data = await reader.read(READ_SIZE)
+        lines = (partial + data).split(b'\n')
+        partial = lines.pop()
+
+        # Read returns empty bytes string when the socket is closed
+        if data == b'':
+            if partial:
+                lines.append(partial)
+                partial = b''
+            else:
                 return
 
-            # Process line in background task
-            loop.create_task(handle_line(metadata, line))
+        # Queue lines for the workers, waiting if the queue is full
+        for line in lines:
+            logger.debug(f'STDIN: {line}')
+            await queue.put((time.monotonic(), line))
+
+        # Stop reading if Squid is not keeping up with responses
+        await writer.drain()
 
 
 async def handle_line(metadata, line):
     """Run an ACL lookup request line from Squid through the processing pipeline."""
-    global writer
-
     request = None
-    result = 'BH'
-    pairs = {}
     try:
         # Get a Request object with parsed fields
+        start = time.perf_counter()
         request = squid.Request(line)
+        PARSE_SECONDS.observe(time.perf_counter() - start)
+
+        # Reuse the previous decision for this client and ACL if sync hasn't stored new data since
+        await metadata.refresh()
+        key = (request.client, request.acl)
+        generation = metadata.generation
+        decision = decisions.get(key, generation)
+
+        if decision is None:
+            # Get metadata from Redis back-end
+            start = time.perf_counter()
+            hostinfo = await metadata.lookup(request)
+            LOOKUP_SECONDS.observe(time.perf_counter() - start)
 
-        # Get metadata from Redis back-end
-        hostinfo = await metadata.lookup(request)
+            # Use metadata to make access decision (OK, ERR, or BH)
+            start = time.perf_counter()
+            result, pairs = await aclmatch.test(request, hostinfo)
+            MATCH_SECONDS.observe(time.perf_counter() - start)
 
-        # Use metadata to make access decision (OK, ERR, or BH)
-        result, pairs = await aclmatch.test(request, hostinfo)
+            decision = (result, squid.encode_response(result, tuple(pairs.items())))
+            decisions.set(key, decision, generation)
+
+        result, body = decision
+        response = request.add_channel(body)
 
     except Exception as e:
         logger.error(f'Exception encountered handling request: {e}', exc_info=True)
@@ -107,13 +216,15 @@ async def handle_line(metadata, line):
         # that errors are reported properly when using concurrency.
         if request is None:
             request = squid.Request(b'- -')
+        result = 'BH'
+        response = request.make_response(result, pairs)
+
+    REQUESTS.inc(result)
 
     # Output response to Squid
-    response = request.make_response(result, pairs)
-    logger.debug(f'STDOUT: {line}')
+    logger.debug(f'STDOUT: {response}')
 
-    writer.write(response)
-    await writer.drain()
+    responses.write(response)
 
 
 @click.option(
@@ -121,6 +232,105 @@ async def handle_line(metadata, line):
     is_flag=True,
     help="Enable debug logging to STDERR."
 )
+@click.option(
+    '--metrics-socket',
+    default=None,
+    type=click.Path(dir_okay=False),
+    help='Serve metrics over HTTP on a Unix socket at this path; {pid} is replaced with the process ID.'
+)
+@click.option(
+    '--decision-cache-ttl',
+    default=60,
+    type=int,
+    help='Time-to-live for ACL responses cached in memory.'
+)
+@click.option(
+    '--decision-cache-size',
+    default=16384,
+    type=int,
+    help='Maximum number of client and ACL pairs to cache responses for in memory (0 to disable).'
+)
+@click.option(
+    '--queue-size',
+    default=1000,
+    type=int,
+    help='Maximum number of requests waiting for a worker before reading from Squid is paused.'
+)
+@click.option(
+    '--workers',
+    default=20,
+    type=int,
+    help='Number of requests to process concurrently; also the Redis connection pool size.'
+)
+@click.option(
+    '--snapshot',
+    default=None,
+    type=click.Path(dir_okay=False),
+    help='Read host metadata from a snapshot file written by sync, instead of Redis.'
+)
+@click.option(
+    '--batch-window',
+    default=1.0,
+    type=float,
+    help='Milliseconds to wait for additional lookups before sending a batch to Redis.'
+)
+@click.option(
+    '--network-fallback',
+    is_flag=True,
+    help='Match addresses that do not belong to a known host against the subnet or VPC containing them.'
+)
+@click.option(
+    '--negative-cache-ttl',
+    default=10,
+    type=int,
+    help='Time-to-live for addresses cached in memory as not belonging to any known host.'
+)
+@click.option(
+    '--cache-ttl',
+    default=60,
+    type=int,
+    help='Time-to-live for host metadata cached in memory.'
+)
+@click.option(
+    '--cache-size',
+    default=4096,
+    type=int,
+    help='Maximum number of hosts to cache metadata for in memory (0 to disable).'
+)
+@click.option(
+    '--layout',
+    default='inline',
+    type=click.Choice(LAYOUTS),
+    help='Layout of lookup keys stored in Redis; must match the layout used by sync.'
+)
+@click.option(
+    '--read-from-replica',
+    is_flag=True,
+    help='Send lookups to replicas discovered through Sentinel or Redis Cluster.'
+)
+@click.option(
+    '--cluster',
+    is_flag=True,
+    help='Redis server is a node of a Redis Cluster.'
+)
+@click.option(
+    '--service-name',
+    default='mymaster',
+    type=str,
+    help='Name of the Redis primary monitored by Sentinel.'
+)
+@click.option(
+    '--sentinel',
+    multiple=True,
+    type=str,
+    help='Sentinel address (HOST:PORT) to discover Redis servers from; may be repeated.'
+)
+@click.option(
+    '--replica',
+    multiple=True,
+    type=str,
+    help='Read-only Redis replica address (HOST:PORT) to send lookups to; may be repeated.'
+)
 @click.option(
     '--port',
     default=6379,
@@ -1,112 +1,865 @@
 import asyncio
+import hashlib
+import ipaddress
 import logging
 import pickle
+import time
 
-import aioredis
+import msgpack
+
+from . import backend
+from .aclmatch import make_network_profile, make_profile
+from .bloom import CountingBloomFilter
+from .cache import LRUCache
+from .metrics import Counter, Histogram
+from .radix import RadixTree
 
 logger = logging.getLogger(__name__)
 
+REDIS_BATCH_SECONDS = Histogram('aws_acl_helper_redis_batch_seconds', 'Time taken to run a pipelined batch of lookups in Redis.')
+REDIS_BATCH_SIZE = Histogram('aws_acl_helper_redis_batch_size', 'Number of addresses in each pipelined batch of lookups.',
+                             buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
+FILTERED_LOOKUPS = Counter('aws_acl_helper_filtered_lookups_total', 'Lookups not sent to Redis because the address is not in the known address filter.')
+
 # Redis key prefixes
 KEY_ENI = __name__ + '^interface^'
 KEY_IP = __name__ + '^ip-to-md^'
 KEY_I = __name__ + '^instance^'
+KEY_PROFILE = __name__ + '^profile^'
+KEY_STATE = __name__ + '^state^'
+KEY_NETWORKS = __name__ + '^networks^'
+KEY_SCOPES = __name__ + '^scopes^'
+KEY_GENERATION = __name__ + '^generation^'
+KEY_MANIFEST = __name__ + '^manifest^'
+KEY_SCOPE_ADDRESSES = __name__ + '^scope-addresses^'
+KEY_ADDRESS = (__name__ + '^address^').encode()
+KEY_RECORD = (__name__ + '^record^').encode()
+
+# Minimum interval between checks of the sync generation counter
+GENERATION_CHECK_INTERVAL = 5
+
+# Maximum number of lookups sent to Redis in a single pipelined batch
+MAX_BATCH_SIZE = 256
+
+# IP and CIDR lookup keys hold the encoded match profile itself, so that every lookup is
+# a single GET of a single key, which works with replicas and clusters. Keys written by
+# older versions hold the name of the key containing the profile instead.
+LEGACY_VALUE_PREFIX = __name__.encode()
+
+# Key layouts. With the 'records' layout, IP lookup keys are named by the packed
+# binary address, and lookup keys hold a short reference to a host record named by
+# a digest of its content, so that a host's profile is stored only once no matter
+# how many addresses it has, and listeners can cache records across generations.
+LAYOUTS = ('inline', 'records')
+RECORD_REFERENCE = b'\x02'
+RECORD_ID_SIZE = 12
+
+# Subnet and VPC CIDR blocks are published per scope, as fields of a single hash that listeners
+# read in one round trip. Subnets take precedence over VPCs with the same CIDR block in the same
+# scope, and blocks claimed by different networks (such as default VPCs in every account and
+# region) are ambiguous, so addresses in them are not matched to any network.
+RANK_VPC = 0
+RANK_SUBNET = 1
+AMBIGUOUS_NETWORK = object()
+
+# False positive rate of the filter of known addresses that listeners build from the packed
+# addresses published by sync for each scope. The filter counts the keys setting each position,
+# so that it can be updated with just the addresses of the scopes that have changed, and is only
+# rebuilt when the total number of addresses outgrows it.
+FILTER_ERROR_RATE = 0.01
 
-# Note - this script will not work with clustered Redis due to
-# use of dynamic key names. Should be fine as long as we're only
-# useing a single local node.
-KEY_SCRIPT = """
-local metadata_key = redis.call('get', ARGV[1]..ARGV[2])
-if metadata_key then
-  return redis.call('get', metadata_key)
+# IPv4 addresses are packed as IPv4-mapped IPv6 addresses so that all keys are the same width
+V4_PREFIX = b'\x00' * 10 + b'\xff\xff'
+PACKED_ADDRESS_SIZE = 16
+
+# Delete an IP lookup key only if it still holds the value (identified by its SHA1
+# digest) that was stored for the object that no longer has the address
+UNMAP_SCRIPT = """
+local value = redis.call('get', KEYS[1])
+if value and redis.sha1hex(value) == ARGV[1] then
+  return redis.call('del', KEYS[1])
 end
+return 0
 """
 
+# Boto3 response fields retained when projecting documents for storage. Values are
+# either the snake_case name to store the field under, or a tuple of the name and
+# a nested schema (applied to dicts or lists of dicts) or conversion function.
+GROUP_SCHEMA = {
+    'GroupId': 'group_id',
+    'GroupName': 'group_name',
+}
+
+INTERFACE_SCHEMA = {
+    'NetworkInterfaceId': 'network_interface_id',
+    'Description': 'description',
+    'OwnerId': 'owner_id',
+    'SubnetId': 'subnet_id',
+    'VpcId': 'vpc_id',
+    'Groups': ('groups', GROUP_SCHEMA),
+    'Association': ('association', {'PublicIp': 'public_ip'}),
+    'Attachment': ('attachment', {'InstanceId': 'instance_id', 'InstanceOwnerId': 'instance_owner_id'}),
+    'PrivateIpAddresses': ('private_ip_addresses', {'PrivateIpAddress': 'private_ip_address'}),
+}
+
+SUBNET_SCHEMA = {
+    'SubnetId': 'subnet_id',
+    'VpcId': 'vpc_id',
+    'OwnerId': 'owner_id',
+    'AvailabilityZone': 'availability_zone',
+}
+
+VPC_SCHEMA = {
+    'VpcId': 'vpc_id',
+    'OwnerId': 'owner_id',
+}
+
+INSTANCE_SCHEMA = {
+    'InstanceId': 'instance_id',
+    'ImageId': 'image_id',
+    'VpcId': 'vpc_id',
+    'Placement': ('placement', {'AvailabilityZone': 'availability_zone'}),
+    'NetworkInterfaces': ('network_interfaces', INTERFACE_SCHEMA),
+}
+
+
+def tag_list_to_dict(tags_list):
+    """Convert Boto3-style key-value tags list into dict"""
+    tags_dict = {}
+
+    for tag in tags_list:
+        if 'key' in tag:
+            tags_dict[tag['key']] = tag['value']
+        elif 'Key' in tag:
+            tags_dict[tag['Key']] = tag['Value']
+
+    return tags_dict
+
+
+def project(document, schema):
+    """Convert a Boto3 CamelCase document to a snake_case dict containing only the fields in schema"""
+    projected = {}
+    for key, spec in schema.items():
+        if key not in document:
+            continue
+
+        value = document[key]
+        if isinstance(spec, str):
+            projected[spec] = value
+            continue
+
+        name, spec = spec
+        if callable(spec):
+            projected[name] = spec(value)
+        elif isinstance(value, list):
+            projected[name] = [project(item, spec) for item in value]
+        else:
+            projected[name] = project(value, spec)
+
+    return projected
+
+
+def project_instance(instance):
+    """Project a Boto3 Instance down to the fields used for ACL matching"""
+    projected = project(instance, INSTANCE_SCHEMA)
+    projected['tags'] = tag_list_to_dict(instance.get('Tags', []))
+    return projected
+
+
+def project_interface(interface):
+    """Project a Boto3 NetworkInterface down to the fields used for ACL matching"""
+    projected = project(interface, INTERFACE_SCHEMA)
+    projected['tags'] = tag_list_to_dict(interface.get('TagSet', []))
+    return projected
+
+
+def associated_cidr_blocks(associations, key):
+    """Return the CIDR blocks from a Boto3 association set that are currently associated"""
+    return [a[key] for a in associations if a.get(key + 'State', {}).get('State', 'associated') == 'associated']
+
+
+def project_subnet(subnet):
+    """Project a Boto3 Subnet down to the fields used for ACL matching, and its CIDR blocks"""
+    projected = project(subnet, SUBNET_SCHEMA)
+    projected['cidr_blocks'] = [subnet['CidrBlock']] + associated_cidr_blocks(subnet.get('Ipv6CidrBlockAssociationSet', []), 'Ipv6CidrBlock')
+    return projected
+
+
+def project_vpc(vpc):
+    """Project a Boto3 Vpc down to the fields used for ACL matching, and its CIDR blocks"""
+    projected = project(vpc, VPC_SCHEMA)
+    projected['cidr_blocks'] = (associated_cidr_blocks(vpc.get('CidrBlockAssociationSet', []), 'CidrBlock') +
+                                associated_cidr_blocks(vpc.get('Ipv6CidrBlockAssociationSet', []), 'Ipv6CidrBlock'))
+    return projected
+
+
+def hash_items(values):
+    """Return the decoded field names and values from the flat list returned by HGETALL"""
+    values = values or []
+    return [(field.decode(), value) for field, value in zip(values[0::2], values[1::2])]
+
+
+def live_scopes(values):
+    """Return the digest of the published addresses of each unexpired scope in the scopes index"""
+    now = time.time()
+    scopes = {}
+    for scope, value in hash_items(values):
+        expires, digest = decode(value)
+        if expires >= now:
+            scopes[scope] = digest
+    return scopes
+
+
+def unpack_addresses(value):
+    """Split the packed addresses published for a scope"""
+    return [value[start:start + PACKED_ADDRESS_SIZE] for start in range(0, len(value), PACKED_ADDRESS_SIZE)]
+
+
+def update_filter(bloom, published, updates):
+    """ Return a copy of a filter of known addresses, and of the packed addresses of each scope it was built from, with changes applied
+
+    Updates map each changed scope to its new packed addresses, or to None if it
+    is gone. Only the addresses that differ are added or removed, unless the total
+    outgrows the filter, in which case a new one is built from every scope.
+    """
+    published = dict(published)
+    previous = {scope: published.pop(scope, b'') for scope in updates}
+    published.update((scope, value) for scope, value in updates.items() if value is not None)
+    total = sum(len(value) for value in published.values()) // PACKED_ADDRESS_SIZE
+    capacity = 1 << max(total - 1, 0).bit_length()
+
+    if bloom is None or bloom.capacity < total:
+        bloom = CountingBloomFilter.for_capacity(capacity, FILTER_ERROR_RATE)
+        for value in published.values():
+            for key in unpack_addresses(value):
+                bloom.add(key)
+        return bloom, published
+
+    bloom = bloom.copy()
+    for scope, value in updates.items():
+        old = set(unpack_addresses(previous[scope]))
+        new = set(unpack_addresses(value or b''))
+        for key in old - new:
+            bloom.remove(key)
+        for key in new - old:
+            bloom.add(key)
+    return bloom, published
+
+
+class PickleCodec(object):
+    """Legacy storage format; pickled Python objects"""
+
+    @staticmethod
+    def encode(obj):
+        return pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def decode(data):
+        return pickle.loads(data)
+
+
+class MsgpackCodec(object):
+    """ Compact storage format; a format marker byte followed by msgpack data
+
+    Match profiles are stored as an array of their values in PROFILE_FIELDS order,
+    with sets stored as plain arrays, so that decoding does not need to create the
+    field names or call back into Python for each set. The set-valued fields of
+    decoded profiles are tuples; the matcher only iterates them, and building
+    frozensets would cost more than the lookups they save. Sets written by older
+    versions as extension types are still understood.
+    """
+    MARKER = b'\x01'
+    PROFILE_MARKER = b'\x03'
+    EXT_FROZENSET = 1
+    PROFILE_FIELDS = ('instance_id', 'image_id', 'vpc_id', 'availability_zone', 'type', 'interface_ids', 'subnet_ids',
+                      'owner_ids', 'group_ids', 'group_names', 'tags', 'user', 'partial')
+
+    @classmethod
+    def encode(cls, obj):
+        if isinstance(obj, dict) and obj.keys() == set(cls.PROFILE_FIELDS):
+            values = [obj[field] for field in cls.PROFILE_FIELDS]
+            return cls.PROFILE_MARKER + msgpack.packb(values, use_bin_type=True, default=cls._default)
+        return cls.MARKER + msgpack.packb(obj, use_bin_type=True, default=cls._default)
+
+    @classmethod
+    def decode(cls, data):
+        if data.startswith(cls.PROFILE_MARKER):
+            return dict(zip(cls.PROFILE_FIELDS, msgpack.unpackb(memoryview(data)[1:], raw=False, use_list=False)))
+        return msgpack.unpackb(memoryview(data)[1:], raw=False, ext_hook=cls._ext_hook)
+
+    @classmethod
+    def _default(cls, obj):
+        if isinstance(obj, (set, frozenset)):
+            return sorted(obj)
+        raise TypeError(f'Cannot serialize {type(obj)}')
+
+    @classmethod
+    def _ext_hook(cls, code, data):
+        if code == cls.EXT_FROZENSET:
+            return frozenset(msgpack.unpackb(data, raw=False))
+        return msgpack.ExtType(code, data)
+
+
+CODECS = {
+    'pickle': PickleCodec,
+    'msgpack': MsgpackCodec,
+}
+
+
+def pack_address(address):
+    """Pack an IP address into 16 bytes, for use in binary keys"""
+    packed = ipaddress.ip_address(address).packed
+    if len(packed) == 4:
+        return V4_PREFIX + packed
+    return packed
+
+
+def address_key(address, layout):
+    """Return the lookup key for an IP address in a key layout"""
+    if layout == 'records':
+        return KEY_ADDRESS + pack_address(address)
+    return KEY_IP + address
+
+
+def state_value_digest(object_id, state):
+    """Return the SHA1 digest of the value that an object's lookup keys were set to, given its stored state"""
+    if len(state) > 2:
+        return state[2]
+    # Lookup keys written by older versions of sync hold the name of the profile key
+    return hashlib.sha1((KEY_PROFILE + object_id).encode()).hexdigest()
+
+
+def decode(data):
+    """Decode data written with any supported codec"""
+    if data.startswith((MsgpackCodec.MARKER, MsgpackCodec.PROFILE_MARKER)):
+        return MsgpackCodec.decode(data)
+    else:
+        return PickleCodec.decode(data)
+
 
 class RedisMetadataReader(object):
     def __init__(self, config):
         self.config = config
-        self.pool = None
+        self.redis = None
+        self.cache = LRUCache(maxsize=config.cache_size, ttl=config.cache_ttl, name='metadata')
+        # Host records are named by a digest of their content, so they are not cleared when the generation changes
+        self.records = LRUCache(maxsize=config.cache_size, ttl=config.cache_ttl, name='record')
+        self.misses = LRUCache(maxsize=config.cache_size, ttl=config.negative_cache_ttl, name='negative')
+        self.networks = RadixTree()
+        self.filter = None
+        self.known = None
+        self.published = {}
+        # Never matches a value from Redis, so that the first check loads networks
+        self.generation = -1
+        self.generation_checked = 0
+        self.pending = []
+        self.flush_handle = None
+        self.inflight = {}
+        self.batches = set()
 
     async def __aenter__(self):
         try:
-            self.pool = await aioredis.create_pool((self.config.redis_host, self.config.redis_port), minsize=1, maxsize=20)
+            self.redis = backend.connect(self.config, readonly=True)
+            await self.redis.connect()
+            await self.check_generation()
             return self
         except Exception as e:
             logger.error(f'Unable to connect to Redis server: {e}')
             raise SystemExit(1)
 
     async def __aexit__(self, exc_type, exc, tb):
-        if self.pool is not None:
-            # Wait for all pool connections to become free, indicating that no tasks are currently using it
-            while self.pool.freesize != self.pool.size:
-                await asyncio.sleep(1)
+        if self.redis is not None:
+            # Send any lookups still waiting for the batch window to expire, and wait for all batches to finish
+            self.flush()
+            if self.batches:
+                await asyncio.wait(self.batches)
+
+            await self.redis.close()
+            self.redis = None
+
+    async def check_generation(self):
+        """Drop cached metadata if sync has stored new data since the last check"""
+        self.generation_checked = time.monotonic()
+        generation = await self.redis.execute('GET', KEY_GENERATION, readonly=True)
+        if generation != self.generation:
+            logger.debug(f'Sync generation changed from {self.generation} to {generation}; clearing cache')
+            # Until the new generation has been loaded, nothing may be answered from the previous one
+            self.generation = object()
+            self.cache.clear()
+            self.misses.clear()
+            self.filter = None
+            await self.load_published()
+            self.generation = generation
+
+    async def load_published(self):
+        """Load the known addresses, and the networks if needed, published by sync for each account and region"""
+        commands = [('HGETALL', KEY_SCOPES)]
+        if self.config.network_fallback:
+            commands.append(('HGETALL', KEY_NETWORKS))
+        results = await self.redis.execute_many(commands, readonly=True)
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+
+        scopes = live_scopes(results[0])
+        await self.load_filter(scopes)
+        if self.config.network_fallback:
+            self.load_networks(scopes, results[1])
+
+    def load_networks(self, scopes, published):
+        """ Build a prefix tree of the subnet and VPC CIDR blocks published by sync for each scope
+
+        Each CIDR block maps to the profile of the most specific network claiming it
+        in each scope, or to AMBIGUOUS_NETWORK if different networks claim it.
+        """
+        claims = {}
+        for scope, value in hash_items(published):
+            if scope not in scopes:
+                continue
+            best = {}
+            for cidr, rank, profile in decode(value):
+                if rank > best.get(cidr, (-1, None))[0]:
+                    best[cidr] = (rank, [profile])
+                elif rank == best[cidr][0]:
+                    best[cidr][1].append(profile)
+            for cidr, (rank, profiles) in best.items():
+                claims.setdefault(cidr, []).extend(profiles)
+
+        networks = RadixTree()
+        ambiguous = 0
+        for cidr, profiles in claims.items():
+            # The same shared subnet may be described by each account it is shared with
+            if any(profile != profiles[0] for profile in profiles):
+                networks.insert(cidr, AMBIGUOUS_NETWORK)
+                ambiguous += 1
+            else:
+                networks.insert(cidr, profiles[0])
+
+        logger.debug(f'Loaded {len(networks)} networks, of which {ambiguous} are ambiguous')
+        self.networks = networks
+
+    async def load_filter(self, scopes):
+        """ Update the filter of known host addresses with those published by sync for each scope
+
+        Only the addresses of scopes whose digest has changed since they were last
+        loaded are fetched, and the filter is updated off the event loop. The filter is
+        only used if every scope that sync has swept has published its addresses;
+        otherwise an address missing from it might still be known.
+        """
+        changed = [scope for scope, digest in scopes.items() if self.published.get(scope, (None,))[0] != digest]
+        values = await self.redis.execute('HMGET', KEY_SCOPE_ADDRESSES, *changed, readonly=True) if changed else []
+        if not scopes or None in values:
+            logger.debug(f'Known addresses are not published for all {len(scopes)} scopes')
+            return
+
+        updates = {scope: None for scope in self.published if scope not in scopes}
+        updates.update(zip(changed, values))
+        if updates:
+            published = {scope: value for scope, (digest, value) in self.published.items()}
+            loop = asyncio.get_event_loop()
+            self.known, published = await loop.run_in_executor(None, update_filter, self.known, published, updates)
+            self.published = {scope: (scopes[scope], value) for scope, value in published.items()}
+            logger.debug(f'Updated known address filter with {len(updates)} changed scopes of {len(scopes)}')
+        self.filter = self.known
 
-            # Ask the connection pool to close any open connections, and wait for it to do so
-            self.pool.close()
-            await self.pool.wait_closed()
-            self.pool = None
+    def is_known(self, address):
+        """Return False if an address is definitely not a host stored by sync"""
+        return self.filter is None or pack_address(address) in self.filter
+
+    async def resolve(self, values):
+        """Replace lookup key values that refer to host records, or to keys written by older versions of sync, with the profiles they refer to"""
+        keys = {}
+        for index, value in enumerate(values):
+            if not isinstance(value, bytes):
+                continue
+            if value.startswith(RECORD_REFERENCE):
+                record = self.records.get(value)
+                if record is not None:
+                    values[index] = record
+                else:
+                    keys.setdefault(KEY_RECORD + value[len(RECORD_REFERENCE):], []).append(index)
+            elif value.startswith(LEGACY_VALUE_PREFIX):
+                keys.setdefault(value, []).append(index)
+
+        if keys:
+            resolved = await self.redis.execute_many([('GET', key) for key in keys], readonly=True)
+            for (key, indexes), value in zip(keys.items(), resolved):
+                if key.startswith(KEY_RECORD) and isinstance(value, bytes):
+                    self.records.set(values[indexes[0]], value)
+                for index in indexes:
+                    values[index] = value
+        return values
+
+    async def refresh(self):
+        """Check the sync generation if it has not been checked recently"""
+        if time.monotonic() - self.generation_checked >= GENERATION_CHECK_INTERVAL:
+            await self.check_generation()
 
     async def lookup(self, request):
         if request.client is None:
             return None
 
+        await self.refresh()
+
+        address = request.client
+        metadata = self.cache.get(address)
+        if metadata is not None:
+            return metadata
+        if self.misses.get(address) is not None:
+            return None
+
+        # Share a single Redis lookup between all concurrent requests from the same address
+        future = self.inflight.get(address)
+        if future is None:
+            future = asyncio.ensure_future(self.load(address))
+            future.add_done_callback(lambda f: self.inflight.pop(address, None))
+            self.inflight[address] = future
+
+        return await asyncio.shield(future)
+
+    async def load(self, address):
+        """Retrieve and decode metadata for an address from Redis, and add it to the cache"""
         metadata = None
+        if self.is_known(address):
+            data = await self.fetch(address)
+        else:
+            FILTERED_LOOKUPS.inc()
+            data = None
+        if data is not None:
+            metadata = decode(data)
+            # IP keys written by older versions of sync may point at the full metadata document
+            if 'user' not in metadata:
+                metadata = make_profile(metadata)
+        else:
+            # Fall back to the subnet or VPC containing the address, if it is not a known host
+            metadata = self.networks.search(address)
+            if metadata is AMBIGUOUS_NETWORK:
+                metadata = None
 
-        # Call the eval script to lookup IP and retrieve instance data.
-        # Could probably optimize this by storing the script server-side
-        # during initial pool creation.
-        with await self.pool as conn:
-            pickle_data = await aioredis.Redis(conn).eval(KEY_SCRIPT, args=[KEY_IP, str(request.client)])
-            if pickle_data is not None:
-                metadata = pickle.loads(pickle_data)
+        if metadata is not None:
+            self.cache.set(address, metadata)
+        else:
+            self.misses.set(address, True)
 
         return metadata
 
+    async def fetch(self, address):
+        """Queue an IP lookup to be sent to Redis with the next pipelined batch"""
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self.pending.append((address, future))
+
+        if len(self.pending) >= MAX_BATCH_SIZE:
+            self.flush()
+        elif self.flush_handle is None:
+            self.flush_handle = loop.call_later(self.config.batch_window / 1000, self.flush)
+
+        return await future
+
+    def flush(self):
+        """Send all pending lookups to Redis in a background task"""
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+
+        batch, self.pending = self.pending, []
+        if batch:
+            task = asyncio.get_event_loop().create_task(self.execute_batch(batch))
+            self.batches.add(task)
+            task.add_done_callback(self.batches.discard)
+
+    async def execute_batch(self, batch):
+        """Get the lookup keys for a batch of addresses, and hand the results back to the waiting futures"""
+        REDIS_BATCH_SIZE.observe(len(batch))
+        try:
+            with REDIS_BATCH_SECONDS.time():
+                keys = [address_key(address, self.config.layout) for address, future in batch]
+                results = await self.redis.execute_many([('GET', key) for key in keys], readonly=True)
+                results = await self.resolve(results)
+        except Exception as e:
+            results = [e] * len(batch)
+
+        for (address, future), result in zip(batch, results):
+            if future.done():
+                continue
+            elif isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
 
 class RedisMetadataWriter(object):
-    def __init__(self, config):
+    """ Store instance and interface metadata into Redis
+
+    Objects are written in pipelined chunks. A digest of each object's content and
+    IP addresses is stored alongside it, so that objects which have not changed
+    since the previous sync only need to have their expiration extended. All
+    profiles are also passed to the optional snapshot writer.
+
+    Every command touches a single key, so that writes can be routed to the
+    primary for each key's hash slot when using Redis Cluster. With the 'records'
+    layout, each profile is stored once as a host record that lookup keys refer to.
+
+    Objects may be stored with a scope (such as an account and region). Once every
+    object in a scope has been stored, sweep removes those stored by the previous
+    sync of that scope that no longer exist, so that their addresses stop matching
+    straight away rather than when their keys expire. The addresses in the scope
+    are published at the same time, so that listeners can build a filter of the
+    addresses of every scope, and answer lookups for other addresses without asking
+    Redis. Objects stored without a scope are not in the filter, so should not be
+    mixed with scoped objects.
+    """
+    def __init__(self, config, snapshot=None):
         self.config = config
-        self.conn = None
+        self.snapshot = snapshot
+        self.redis = None
+        self.codec = CODECS[config.codec]
+        self.pending = []
+        self.changed = 0
+        self.notified = 0
+        self.seen = {}
+        self.addresses = {}
+        self.networks = {}
 
     async def __aenter__(self):
         try:
-            self.conn = await aioredis.create_connection((self.config.redis_host, self.config.redis_port))
-            await self.conn.execute('MULTI')
+            await self.connect()
             return self
         except Exception as e:
             logger.error(f'Unable to connect to Redis server: {e}')
             raise SystemExit(1)
 
     async def __aexit__(self, exc_type, exc, tb):
-        if self.conn is not None:
-            await self.conn.execute('EXEC')
-            self.conn.close()
-            await self.conn.wait_closed()
-            self.conn = None
+        if self.redis is not None:
+            await self.commit()
+            await self.redis.close()
+            self.redis = None
+
+    async def connect(self):
+        self.redis = backend.connect(self.config)
+        await self.redis.connect()
+
+    async def commit(self):
+        """Write any queued objects, and notify listeners if anything has changed"""
+        await self.flush()
+        await self.notify()
+        logger.info(f'Stored {self.changed} changed objects')
+        self.changed = self.notified = 0
+
+    async def notify(self):
+        """Bump the generation counter so that listeners drop any cached metadata, if anything has changed since the last bump"""
+        if self.changed > self.notified:
+            await self.redis.execute('INCR', KEY_GENERATION)
+            self.notified = self.changed
+
+    async def store_instance(self, instance, scope=None):
+        addresses = [address for interface in instance.get('network_interfaces', []) for address in get_addresses(interface)]
+        await self.store(KEY_I, instance['instance_id'], instance, make_profile(instance), addresses, scope=scope)
+
+    async def store_interface(self, interface, scope=None):
+        # Addresses of interfaces attached to an instance are mapped to the instance instead
+        if 'instance_id' in interface.get('attachment', {}):
+            addresses = []
+        else:
+            addresses = get_addresses(interface)
+        await self.store(KEY_ENI, interface['network_interface_id'], interface, make_profile(interface), addresses, scope=scope)
+
+    async def store_network(self, network, scope=None):
+        """ Store a subnet or VPC, so that addresses in its CIDR blocks can be matched before their hosts are synced
+
+        CIDR blocks are only published for listeners when the network's scope is swept,
+        and networks stored without a scope are not published at all.
+        """
+        if scope is not None and self.networks.get(scope, []) is not None:
+            rank = RANK_SUBNET if 'subnet_id' in network else RANK_VPC
+            profile = make_network_profile(network)
+            self.networks.setdefault(scope, []).extend([cidr, rank, profile] for cidr in network['cidr_blocks'])
+
+    def keep_networks(self, scope):
+        """Keep the networks published by the previous sync of a scope, instead of any stored since begin, when they could not all be described"""
+        self.networks[scope] = None
+
+    async def store(self, prefix, object_id, document, profile, addresses, scope=None):
+        """Queue an object for storage, sending queued objects to Redis once a full chunk is ready"""
+        if scope is not None:
+            self.seen.setdefault(scope, set()).add((prefix, object_id))
+            self.addresses.setdefault(scope, set()).update(addresses)
+        if self.snapshot is not None:
+            self.snapshot.add(profile, addresses, int(self.config.redis_ttl), scope)
+        self.pending.append((prefix, object_id, document, profile, addresses))
+        if len(self.pending) >= self.config.chunk_size:
+            await self.flush()
+
+    async def flush(self):
+        """Write all queued objects to Redis in a single pipelined round trip"""
+        pending, self.pending = self.pending, []
+        if not pending:
+            return
+
+        ttl = int(self.config.redis_ttl)
+        states = await self.redis.execute_many([('GET', KEY_STATE + item[1]) for item in pending])
+        commands = []
+        refreshed = []
+
+        for (prefix, object_id, document, profile, addresses), state in zip(pending, states):
+            if isinstance(state, Exception):
+                raise state
+
+            layout = self.config.layout
+            lookup_keys = [address_key(address, layout) for address in addresses]
+            digest = hashlib.sha1(MsgpackCodec.encode([self.config.codec, layout, document, profile])).hexdigest()
+            old_state = decode(state) if state else [None, [], None, []]
+            old_digest, old_lookup_keys = old_state[:2]
+            write = (prefix, object_id, document, profile, lookup_keys, digest, old_state)
+
+            if digest == old_digest and lookup_keys == old_lookup_keys and len(old_state) > 3:
+                keys = [prefix + object_id, KEY_STATE + object_id] + lookup_keys + old_state[3]
+                refreshed.append((len(commands), len(keys), write))
+                commands.extend(('EXPIRE', key, ttl) for key in keys)
+                continue
+
+            commands.extend(self.write_commands(*write, ttl))
+
+        results = await self.execute_commands(commands)
+
+        # Keys can be lost while the object's state survives (through eviction, or failover to a replica that
+        # had not received them yet), so unchanged objects are rewritten if any of their keys no longer exist
+        missing = [write for start, count, write in refreshed if not all(results[start:start + count])]
+        if missing:
+            logger.info(f'Rewriting {len(missing)} unchanged objects with missing keys')
+            await self.execute_commands([command for write in missing for command in self.write_commands(*write, ttl)])
+
+    def write_commands(self, prefix, object_id, document, profile, lookup_keys, digest, old_state, ttl):
+        """Return the commands to store an object that has changed since the previous sync"""
+        # Store encoded data keyed off object ID, and the encoded match profile under each lookup key
+        # (or once, as a record that each lookup key refers to), so that we can find metadata given
+        # only an IP address
+        self.changed += 1
+        commands = []
+        value = self.codec.encode(profile)
+        record_keys = []
+        # Objects without addresses (such as detached interfaces) have no lookup keys to refer to a record
+        if self.config.layout == 'records' and lookup_keys:
+            record_id = hashlib.sha1(value).digest()[:RECORD_ID_SIZE]
+            record_keys.append(KEY_RECORD + record_id)
+            commands.append(('SET', KEY_RECORD + record_id, value, 'EX', ttl))
+            value = RECORD_REFERENCE + record_id
+        value_digest = hashlib.sha1(value).hexdigest()
+        commands.append(('SET', prefix + object_id, self.codec.encode(document), 'EX', ttl))
+        commands.append(('SET', KEY_STATE + object_id, MsgpackCodec.encode([digest, lookup_keys, value_digest, record_keys]), 'EX', ttl))
+        for key in lookup_keys:
+            commands.append(('SET', key, value, 'EX', ttl))
+
+        # Remove lookups for addresses that no longer belong to this object, unless already claimed by another
+        for key in set(old_state[1]).difference(lookup_keys):
+            commands.append(('EVAL', UNMAP_SCRIPT, 1, key, state_value_digest(object_id, old_state)))
+        return commands
+
+    async def begin(self, scope):
+        """ Start tracking the objects stored for a scope, forgetting any from an incomplete earlier sync
+
+        A scope is only added to the scopes index by its first sweep, so hosts stored
+        by a sync that has not yet been swept are not in the known address filter,
+        and are not matched until the sweep.
+        """
+        self.seen[scope] = set()
+        self.addresses[scope] = set()
+        self.networks[scope] = []
+
+    async def sweep(self, scope):
+        """ Remove objects stored by the previous sync of a scope that were not stored by this one
+
+        Must only be called once every object in the scope has been stored, since
+        anything not stored since begin was called is deleted. The objects in each
+        scope are recorded in a manifest key for the next sync to compare against.
+        Listeners are notified as soon as the scope's addresses have been published.
+        """
+        await self.flush()
+        seen = self.seen.pop(scope, set())
+        addresses = self.addresses.pop(scope, set())
+        networks = self.networks.pop(scope, [])
+        ttl = int(self.config.redis_ttl)
+        manifest, scopes, exists, published_networks = await self.redis.execute_many([('GET', KEY_MANIFEST + scope), ('HGETALL', KEY_SCOPES),
+                                                                                      ('HEXISTS', KEY_SCOPE_ADDRESSES, scope),
+                                                                                      ('HGET', KEY_NETWORKS, scope)])
+        for result in (manifest, scopes, exists, published_networks):
+            if isinstance(result, Exception):
+                raise result
+        removed = sorted(set(tuple(item) for item in decode(manifest)).difference(seen)) if manifest else []
+
+        commands = []
+        if removed:
+            states = await self.redis.execute_many([('GET', KEY_STATE + object_id) for prefix, object_id in removed])
+            for (prefix, object_id), state in zip(removed, states):
+                if isinstance(state, Exception):
+                    raise state
+                logger.info(f'Removing data for {object_id}')
+                # Lookup keys are only removed if they have not since been claimed by another object
+                if state:
+                    state = decode(state)
+                    for key in state[1]:
+                        commands.append(('EVAL', UNMAP_SCRIPT, 1, key, state_value_digest(object_id, state)))
+                commands.append(('UNLINK', prefix + object_id))
+                commands.append(('UNLINK', KEY_STATE + object_id))
+            self.changed += len(removed)
 
-    async def store_instance(self, instance):
-        instance_id = instance['instance_id']
+        commands.append(('SET', KEY_MANIFEST + scope, MsgpackCodec.encode(sorted(seen)), 'EX', ttl))
 
-        for interface in instance.get('network_interfaces', []):
-            await self.store_interface(interface, KEY_I + instance_id)
+        # Publish the scope's addresses if they have changed, and forget scopes that have not been swept within the TTL
+        published = b''.join(sorted(pack_address(address) for address in addresses))
+        digest = hashlib.sha1(published).hexdigest()
+        now = time.time()
+        previous = None
+        expired = []
+        for field, value in hash_items(scopes):
+            expires, field_digest = decode(value)
+            if field == scope:
+                previous = field_digest
+            elif expires < now:
+                expired.append(field)
+        if expired:
+            for key in (KEY_SCOPES, KEY_SCOPE_ADDRESSES, KEY_NETWORKS):
+                commands.append(('HDEL', key, *expired))
+        if digest != previous or not exists:
+            commands.append(('HSET', KEY_SCOPE_ADDRESSES, scope, published))
+            self.changed += 1
+        commands.append(('HSET', KEY_SCOPES, scope, MsgpackCodec.encode([int(now) + ttl, digest])))
+        if networks is not None and MsgpackCodec.encode(networks) != published_networks:
+            commands.append(('HSET', KEY_NETWORKS, scope, MsgpackCodec.encode(networks)))
+            self.changed += 1
+        for key in (KEY_SCOPES, KEY_SCOPE_ADDRESSES, KEY_NETWORKS):
+            commands.append(('EXPIRE', key, ttl))
+        await self.execute_commands(commands)
+        await self.notify()
 
-        redis = aioredis.Redis(self.conn)
+        if self.snapshot is not None:
+            self.snapshot.sweep(scope, addresses)
+        logger.info(f'Removed {len(removed)} objects no longer present in {scope}')
 
-        # Store pickled instance data keyed off instance ID
-        await redis.set(key=KEY_I + instance_id, value=pickle.dumps(instance, pickle.HIGHEST_PROTOCOL), expire=int(self.config.redis_ttl))
+    async def abandon(self, scope):
+        """ Stop tracking a scope whose sync did not complete
 
-    async def store_interface(self, interface, key=None):
-        redis = aioredis.Redis(self.conn)
-        interface_id = interface['network_interface_id']
+        The scope's published addresses are left as they are, so hosts stored since it
+        was last swept are not matched until its next complete sync.
+        """
+        self.seen.pop(scope, None)
+        self.addresses.pop(scope, None)
+        self.networks.pop(scope, None)
 
-        # Only store picked interface data if using default key (not fixed key from instance)
-        if not key:
-            key = KEY_ENI + interface_id
-            await redis.set(key=KEY_ENI + interface_id, value=pickle.dumps(interface, pickle.HIGHEST_PROTOCOL), expire=int(self.config.redis_ttl))
+    async def execute_commands(self, commands):
+        """Send commands to Redis in a single pipelined round trip, returning their results or raising the first error"""
+        results = await self.redis.execute_many(commands)
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        return results
 
-        # Store intermediate key lookups so that we can find metadata given only an IP address
-        if 'association' in interface:
-            await redis.set(key=KEY_IP + interface['association']['public_ip'], value=key, expire=int(self.config.redis_ttl))
 
-        for address in interface.get('private_ip_addresses', []):
-            await redis.set(key=KEY_IP + address['private_ip_address'], value=key, expire=int(self.config.redis_ttl))
+def get_addresses(interface):
+    """Return all public and private IP addresses of an interface"""
+    addresses = []
+    if 'association' in interface:
+        addresses.append(interface['association']['public_ip'])
+    for address in interface.get('private_ip_addresses', []):
+        addresses.append(address['private_ip_address'])
+    return addresses
@@ -0,0 +1,187 @@
+import asyncio
+import bisect
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# All metrics created by any module, in the order they were defined
+REGISTRY = []
+
+# Histogram buckets (in seconds) suitable for per-request latencies
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+class Metric(object):
+    """ Base class for a named metric with optional labels
+
+    Metrics register themselves on creation, and are rendered in the Prometheus
+    text exposition format. Values are keyed by a tuple of label values.
+    """
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        REGISTRY.append(self)
+
+    def format_labels(self, labelvalues, extra=()):
+        pairs = list(zip(self.labelnames, labelvalues)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{key}="{escape(value)}"' for key, value in pairs) + '}'
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for labelvalues in sorted(self.values):
+            lines.extend(self.samples(labelvalues, self.values[labelvalues]))
+        return lines
+
+    def samples(self, labelvalues, value):
+        return [f'{self.name}{self.format_labels(labelvalues)} {value}']
+
+
+class Counter(Metric):
+    """Monotonically increasing count of events"""
+    kind = 'counter'
+
+    def inc(self, *labelvalues, amount=1):
+        self.values[labelvalues] = self.values.get(labelvalues, 0) + amount
+
+
+class Gauge(Metric):
+    """Value that can go up and down, either set directly or read from a function when rendered"""
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.function = None
+
+    def set(self, value, *labelvalues):
+        self.values[labelvalues] = value
+
+    def set_function(self, function):
+        self.function = function
+
+    def render(self):
+        if self.function is not None:
+            self.values[()] = self.function()
+        return super().render()
+
+
+class Histogram(Metric):
+    """Distribution of observed values, counted into cumulative buckets"""
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labelvalues):
+        state = self.values.get(labelvalues)
+        if state is None:
+            state = self.values[labelvalues] = [[0] * (len(self.buckets) + 1), 0]
+        state[0][bisect.bisect_left(self.buckets, value)] += 1
+        state[1] += value
+
+    @contextmanager
+    def time(self, *labelvalues):
+        """Observe the number of seconds taken to run the body of a with statement"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labelvalues)
+
+    def samples(self, labelvalues, state):
+        counts, total = state
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append(f'{self.name}_bucket{self.format_labels(labelvalues, [("le", le)])} {cumulative}')
+        lines.append(f'{self.name}_sum{self.format_labels(labelvalues)} {total}')
+        lines.append(f'{self.name}_count{self.format_labels(labelvalues)} {cumulative}')
+        return lines
+
+
+def escape(value):
+    """Escape a label value for the Prometheus text format"""
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def render():
+    """Render all registered metrics in the Prometheus text exposition format"""
+    return ''.join(line + '\n' for metric in REGISTRY for line in metric.render())
+
+
+def dump():
+    """Write all metrics to STDERR"""
+    sys.stderr.write(render())
+    sys.stderr.flush()
+
+
+async def handle_scrape(reader, writer):
+    """Answer any HTTP request with the current metrics"""
+    try:
+        while (await reader.readline()).strip():
+            pass
+        body = render().encode()
+        writer.write(b'HTTP/1.0 200 OK\r\n'
+                     b'Content-Type: text/plain; version=0.0.4\r\n'
+                     b'Content-Length: %d\r\n\r\n%s' % (len(body), body))
+        await writer.drain()
+    except Exception as e:
+        logger.debug(f'Failed to send metrics: {e}')
+    finally:
+        writer.close()
+
+
+async def start_server(port=None, path=None):
+    """ Dump metrics to STDERR on SIGUSR1, and serve them over HTTP if a port or Unix socket path is given
+
+    Any {pid} in the socket path is replaced with the current process ID, so that
+    each of several helper processes started by Squid can have its own socket.
+    """
+    loop = asyncio.get_event_loop()
+    loop.add_signal_handler(signal.SIGUSR1, dump)
+
+    # Metrics are not worth failing for, so carry on without a server that cannot be started
+    servers = []
+    if port:
+        try:
+            servers.append(await asyncio.start_server(handle_scrape, 'localhost', port))
+        except OSError as e:
+            logger.error(f'Unable to serve metrics on port {port}: {e}')
+    if path:
+        path = path.format(pid=os.getpid())
+        try:
+            if os.path.exists(path):
+                os.unlink(path)
+            servers.append(await asyncio.start_unix_server(handle_scrape, path))
+        except OSError as e:
+            logger.error(f'Unable to serve metrics on {path}: {e}')
+
+    for server in servers:
+        for sock in server.sockets:
+            logger.info(f'Serving metrics on {sock.getsockname()}')
+
+    return servers
+
+
+async def stop_server(servers):
+    """Close metrics servers started by start_server, removing any Unix sockets"""
+    for server in servers:
+        paths = [sock.getsockname() for sock in server.sockets if sock.family == socket.AF_UNIX]
+        server.close()
+        await server.wait_closed()
+        for path in paths:
+            os.unlink(path)
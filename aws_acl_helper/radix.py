@@ -0,0 +1,48 @@
+import ipaddress
+
+
+class RadixTree(object):
+    """ Binary prefix tree for longest-prefix matching of IP addresses against networks
+
+    Each node is a list of [zero child, one child, value]. Searching walks at most
+    one node per bit of the address, regardless of how many networks are stored.
+    """
+    def __init__(self):
+        self.roots = {4: [None, None, None], 6: [None, None, None]}
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def insert(self, network, value):
+        """Store a value for a network, given as a string or ipaddress network object"""
+        network = ipaddress.ip_network(network, strict=False)
+        bits = int(network.network_address)
+        width = network.max_prefixlen
+
+        node = self.roots[network.version]
+        for position in range(width - 1, width - 1 - network.prefixlen, -1):
+            bit = (bits >> position) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, None]
+            node = node[bit]
+
+        if node[2] is None:
+            self.size += 1
+        node[2] = value
+
+    def search(self, address):
+        """Return the value for the most specific network containing an address, or None"""
+        address = ipaddress.ip_address(address)
+        bits = int(address)
+
+        node = self.roots[address.version]
+        value = node[2]
+        for position in range(address.max_prefixlen - 1, -1, -1):
+            node = node[(bits >> position) & 1]
+            if node is None:
+                break
+            if node[2] is not None:
+                value = node[2]
+
+        return value
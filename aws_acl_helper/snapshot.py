@@ -0,0 +1,235 @@
+import fcntl
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import time
+
+from .cache import LRUCache
+from .metadata import GENERATION_CHECK_INTERVAL, MsgpackCodec, decode, pack_address
+
+logger = logging.getLogger(__name__)
+
+# Snapshot file layout:
+#   header:  magic, number of index entries, offset and length of the scope table
+#   index:   sorted fixed-width entries of packed address, record offset, record length,
+#            scope number and expiry time
+#   records: msgpack-encoded match profiles, shared by all addresses of the same host
+#   scopes:  msgpack-encoded list of the account^region scope of each scope number
+MAGIC = b'AWSACL\x00\x02'
+HEADER = struct.Struct('!8sIII')
+ENTRY = struct.Struct('!16sIIHI')
+
+
+class SnapshotWriter(object):
+    """ Collect match profiles during sync and write them to an immutable snapshot file
+
+    Each address expires after its TTL unless stored again, so that a long-running
+    sync drops hosts in the same way that Redis would. Addresses are tracked by the
+    scope they were synced in, so that hosts swept from a scope are also dropped,
+    and so that separate syncs can share a file: each write replaces the scopes
+    this writer has completely synced, and keeps the rest of the existing file.
+
+    Writing is split into collect, which must run on the same thread as add and
+    sweep, and save, which may run on a worker thread.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.addresses = {}
+        self.scopes = set()
+        self.dirty = False
+
+    def add(self, profile, addresses, ttl, scope=None):
+        expires = int(time.time() + ttl)
+        record = MsgpackCodec.encode(profile)
+        for address in addresses:
+            self.addresses[pack_address(address)] = (expires, record, scope)
+        self.dirty = True
+
+    def sweep(self, scope, addresses):
+        """Drop the addresses of a completely synced scope that were not stored by its latest sync"""
+        keep = set(pack_address(address) for address in addresses)
+        self.scopes.add(scope)
+        self.addresses = {key: value for key, value in self.addresses.items() if value[2] != scope or key in keep}
+        self.dirty = True
+
+    def read(self, swept):
+        """Return the unexpired addresses in the existing snapshot file, except those of the given swept scopes"""
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+            magic, count, scopes_offset, scopes_length = HEADER.unpack_from(data)
+        except FileNotFoundError:
+            return {}
+        except (OSError, struct.error) as e:
+            logger.warning(f'Unable to read existing snapshot {self.path}; replacing it: {e}')
+            return {}
+
+        if magic != MAGIC:
+            logger.warning(f'Replacing existing snapshot with unknown format {magic}')
+            return {}
+
+        scopes = decode(data[scopes_offset:scopes_offset + scopes_length])
+        now = time.time()
+        addresses = {}
+        for start in range(HEADER.size, HEADER.size + count * ENTRY.size, ENTRY.size):
+            key, offset, length, scope, expires = ENTRY.unpack_from(data, start)
+            scope = scopes[scope]
+            if scope not in swept and expires >= now:
+                addresses[key] = (expires, data[offset:offset + length], scope)
+        return addresses
+
+    def write(self):
+        """Merge with the existing snapshot in a temporary file and atomically rename it into place"""
+        self.save(*self.collect())
+
+    def collect(self):
+        """Drop expired addresses, and return copies of the addresses and swept scopes to save"""
+        now = time.time()
+        self.addresses = {key: value for key, value in self.addresses.items() if value[0] >= now}
+        self.dirty = False
+        return dict(self.addresses), set(self.scopes)
+
+    def save(self, addresses, swept):
+        """Merge collected addresses with the existing snapshot in a temporary file and atomically rename it into place"""
+        directory = os.path.dirname(os.path.abspath(self.path))
+        # Hold a lock while merging, so that concurrent syncs do not drop each other's scopes
+        with open(os.path.join(directory, f'.{os.path.basename(self.path)}.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            collected = addresses
+            addresses = self.read(swept)
+            addresses.update(collected)
+            keys = sorted(addresses)
+
+            offsets = {}
+            scopes = {}
+            records = []
+            position = HEADER.size + ENTRY.size * len(keys)
+            index = []
+            for key in keys:
+                expires, record, scope = addresses[key]
+                if record not in offsets:
+                    offsets[record] = position
+                    position += len(record)
+                    records.append(record)
+                scope = scopes.setdefault(scope, len(scopes))
+                index.append(ENTRY.pack(key, offsets[record], len(record), scope, expires))
+            scope_table = MsgpackCodec.encode(sorted(scopes, key=scopes.get))
+
+            fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.snapshot-')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(HEADER.pack(MAGIC, len(keys), position, len(scope_table)))
+                    f.writelines(index)
+                    f.writelines(records)
+                    f.write(scope_table)
+                os.chmod(temp_path, 0o644)
+                os.replace(temp_path, self.path)
+            except Exception:
+                os.unlink(temp_path)
+                raise
+
+        logger.info(f'Wrote snapshot of {len(keys)} addresses and {len(records)} hosts to {self.path}')
+
+
+class SnapshotMetadataReader(object):
+    """ Look up host match profiles from a memory-mapped snapshot file
+
+    Drop-in replacement for RedisMetadataReader for listeners that do not have
+    access to Redis. The file is reopened whenever sync replaces it.
+    """
+    def __init__(self, config):
+        self.config = config
+        self.cache = LRUCache(maxsize=config.cache_size, ttl=config.cache_ttl, name='metadata')
+        self.mmap = None
+        self.count = 0
+        self.generation = None
+        self.generation_checked = 0
+
+    async def __aenter__(self):
+        self.check_generation()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+            self.count = 0
+
+    def check_generation(self):
+        """Reopen the snapshot if it has been replaced since the last check"""
+        self.generation_checked = time.monotonic()
+        try:
+            stat = os.stat(self.config.snapshot)
+            generation = (stat.st_ino, stat.st_mtime_ns)
+        except OSError as e:
+            generation = None
+            if self.generation is not None:
+                logger.warning(f'Unable to read snapshot: {e}')
+
+        if generation == self.generation:
+            return
+
+        logger.debug(f'Snapshot changed from {self.generation} to {generation}; reloading')
+        self.close()
+        self.cache.clear()
+        self.generation = generation
+        if generation is None:
+            return
+
+        try:
+            with open(self.config.snapshot, 'rb') as f:
+                self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, self.count, _, _ = HEADER.unpack_from(self.mmap)
+        except (OSError, ValueError, struct.error) as e:
+            logger.warning(f'Unable to load snapshot: {e}')
+            self.close()
+            return
+
+        if magic != MAGIC:
+            logger.warning(f'Ignoring snapshot with unknown format {magic}')
+            self.close()
+
+    def find(self, key):
+        """Binary search the snapshot index for a packed address, returning the encoded record"""
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            start = HEADER.size + middle * ENTRY.size
+            candidate = self.mmap[start:start + 16]
+            if candidate < key:
+                low = middle + 1
+            elif candidate > key:
+                high = middle
+            else:
+                _, offset, length, _, expires = ENTRY.unpack_from(self.mmap, start)
+                if expires < time.time():
+                    return None
+                return self.mmap[offset:offset + length]
+        return None
+
+    async def refresh(self):
+        """Check the snapshot file if it has not been checked recently"""
+        if time.monotonic() - self.generation_checked >= GENERATION_CHECK_INTERVAL:
+            self.check_generation()
+
+    async def lookup(self, request):
+        if request.client is None:
+            return None
+
+        await self.refresh()
+
+        address = request.client
+        metadata = self.cache.get(address)
+        if metadata is None and self.mmap is not None:
+            data = self.find(pack_address(address))
+            if data is not None:
+                metadata = decode(data)
+                self.cache.set(address, metadata)
+
+        return metadata
@@ -1,3 +1,4 @@
+import functools
 import ipaddress
 from urllib.parse import quote, unquote
 
@@ -5,44 +6,67 @@ from urllib.parse import quote, unquote
 _squid_keywords = frozenset(['clt_conn_tag', 'group', 'log', 'message', 'password', 'tag', 'ttl', 'user'])
 
 
+@functools.lru_cache(maxsize=4096)
+def parse_address(token):
+    """Validate a client address token, returning the address as a normalized string or None"""
+    try:
+        return str(ipaddress.ip_address(token.decode()))
+    except ValueError:
+        return None
+
+
+@functools.lru_cache(maxsize=1024)
+def parse_acl(token):
+    """Split and unquote the ACL arguments from a request; the same argument strings recur constantly"""
+    return tuple(unquote(p) for p in token.decode().split(' '))
+
+
+@functools.lru_cache(maxsize=4096)
+def encode_response(result, pairs):
+    """Encode a response line, minus the channel ID, from a result and tuple of keyword pairs"""
+    # Check for valid keywords; underscore suffix is reserved for admin use
+    # reference: http://wiki.squid-cache.org/Features/AddonHelpers#Access_Control_.28ACL.29
+    parts = [result]
+    for key, value in pairs:
+        if key[-1] == '_' or key in _squid_keywords:
+            parts.append(f'{key}={quote(value)}')
+
+    return (' '.join(parts) + '\n').encode()
+
+
 class Request:
     """Container object for Squid ACL lookup request"""
-    _channel = -1
-    _client = None
-    _acl = list()
+    __slots__ = ('_channel', '_client', '_acl')
 
     def __init__(self, line):
         """Parse a lookup request from Squid into its constituent parts"""
-        parts = line.decode().replace('\n', '').split(' ')
+        token, sep, rest = line.rstrip(b'\n').partition(b' ')
 
         # See if we're using concurrency; if so the first token is the integer channel ID
         try:
-            self._channel = int(parts[0])
-            parts.pop(0)
+            self._channel = int(token)
+            token, sep, rest = rest.partition(b' ')
         except ValueError:
-            pass
+            self._channel = -1
 
         # First non-channel argument must be the client IP address
         # Failure to parse the client address is handled later on
         # by detecting the object's client property being None.
-        addr = parts.pop(0)
-        if addr != '-':
-            try:
-                self._client = ipaddress.ip_address(addr)
-            except ValueError:
-                pass
+        self._client = None
+        if token != b'-':
+            self._client = parse_address(token)
 
         # Everything else is ACL arguments
-        self._acl = [unquote(p) for p in parts]
+        self._acl = parse_acl(rest) if sep else ()
 
     @property
     def client(self):
-        """IP address of the client that made the current request"""
+        """IP address of the client that made the current request, as a string"""
         return self._client
 
     @property
     def acl(self):
-        """List of ACL entries to test the current request against"""
+        """Tuple of ACL entries to test the current request against"""
         return self._acl
 
     def make_response(self, result='BH', pairs=dict()):
@@ -53,27 +77,10 @@ class Request:
             See the Squid documentation for valid keywords:
             http://wiki.squid-cache.org/Features/AddonHelpers#Access_Control_.28ACL.29
         """
-        chan = None
-        pair = None
-        keywords = {}
-
-        # Check for valid keywords; underscore suffix is reserved for admin use
-        # reference: http://wiki.squid-cache.org/Features/AddonHelpers#Access_Control_.28ACL.29
-        for key, value in pairs.items():
-            if key[-1] == '_' or key in _squid_keywords:
-                keywords[key] = value
-            else:
-                # FIXME - log this
-                pass
-
-        # Include channel if it was specified in the request
-        if self._channel != -1:
-            chan = str(self._channel)
+        return self.add_channel(encode_response(result, tuple(pairs.items())))
 
-        # Join together valid keywords
-        if len(keywords) > 0:
-            pair = ' '.join([f'{item[0]}={quote(item[1])}' for item in keywords.items()])
-
-        # Only include defined items in response line
-        line = ' '.join([p for p in [chan, result, pair] if p is not None])+'\n'
-        return line.encode()
+    def add_channel(self, line):
+        """Prefix an encoded response line with the channel ID, if one was specified in the request"""
+        if self._channel != -1:
+            return b'%d %s' % (self._channel, line)
+        return line
@@ -1,67 +1,59 @@
 import asyncio
+import fcntl
+import functools
 import json
 import logging
+import os
+import random
+import tempfile
+import threading
 import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
 import botocore
+import botocore.config
+import botocore.session
 import click
+from botocore.credentials import RefreshableCredentials
 
+from . import metrics
 from .config import Config, parse_file
-from .metadata import RedisMetadataWriter
+from .metadata import CODECS, LAYOUTS, RedisMetadataWriter, project_instance, project_interface, project_subnet, project_vpc
+from .snapshot import SnapshotWriter
 
 _session_cache = {}
+_client_cache = {}
+_account_cache = {}
+_cache_locks = defaultdict(threading.Lock)
+_cache_locks_lock = threading.Lock()
+_credential_cache_lock = threading.Lock()
 logger = logging.getLogger(__name__)
 
+# Retry throttled API calls with exponential backoff before giving up on a region
+BOTO_CONFIG = botocore.config.Config(retries={'max_attempts': 10})
 
-def camel_dict_to_snake_dict(camel_dict):
-    """Convert Boto3 CamelCase dict to snake_case dict"""
-    def camel_to_snake(name):
+# Fraction of the sync interval to randomly add or remove, and the largest
+# fraction of the metadata TTL that the daemon will wait between syncs
+INTERVAL_JITTER = 0.1
+MAX_INTERVAL_RATIO = 0.5
 
-        import re
+# Assumed role credentials are refreshed when they have less than 15 minutes left, so credentials
+# from the cache file are only reused if they have longer than this left
+CREDENTIAL_MIN_LIFETIME = 20 * 60
 
-        first_cap_re = re.compile('(.)([A-Z][a-z]+)')
-        all_cap_re = re.compile('([a-z0-9])([A-Z])')
-        s1 = first_cap_re.sub(r'\1_\2', name)
+# Number of pages that may be fetched from the EC2 API ahead of those being stored in Redis
+PREFETCH_PAGES = 2
 
-        return all_cap_re.sub(r'\1_\2', s1).lower()
+# Seconds between snapshot writes by the daemon, which only writes if any region has been synced since the last one
+SNAPSHOT_INTERVAL = 30
 
-    def value_is_list(camel_list):
-
-        checked_list = []
-        for item in camel_list:
-            if isinstance(item, dict):
-                checked_list.append(camel_dict_to_snake_dict(item))
-            elif isinstance(item, list):
-                checked_list.append(value_is_list(item))
-            else:
-                checked_list.append(item)
-
-        return checked_list
-
-    snake_dict = {}
-    for k, v in camel_dict.items():
-        if isinstance(v, dict):
-            snake_dict[camel_to_snake(k)] = camel_dict_to_snake_dict(v)
-        elif isinstance(v, list):
-            snake_dict[camel_to_snake(k)] = value_is_list(v)
-        else:
-            snake_dict[camel_to_snake(k)] = v
-
-    return snake_dict
-
-
-def tag_list_to_dict(tags_list):
-    """Convert Boto3-style key-value tags list into dict"""
-    tags_dict = {}
-
-    for tag in tags_list:
-        if 'key' in tag:
-            tags_dict[tag['key']] = tag['value']
-        elif 'Key' in tag:
-            tags_dict[tag['Key']] = tag['Value']
-
-    return tags_dict
+SYNC_DURATION = metrics.Gauge('aws_acl_helper_sync_duration_seconds', 'Duration of the most recent sync, by account and region.',
+                              ['account', 'region'])
+SYNC_OBJECTS = metrics.Gauge('aws_acl_helper_sync_objects', 'Number of objects found by the most recent sync, by account, region and type.',
+                             ['account', 'region', 'type'])
+SYNC_ERRORS = metrics.Counter('aws_acl_helper_sync_errors_total', 'Failed syncs, by account and region.', ['account', 'region'])
 
 
 def get_instance_region():
@@ -77,89 +69,477 @@ def get_instance_region():
     return data.get('region', None)
 
 
+def cache_lock(*key):
+    """ Return the lock for an entry in one of the session, client or account caches
+
+    Sessions and clients are created on worker threads, so each cache entry is
+    created under its own lock, both to avoid duplicate STS calls when several
+    regions or accounts start at once, and because Boto3 Sessions are not thread
+    safe: clients are only created from a session while holding its lock.
+    """
+    with _cache_locks_lock:
+        return _cache_locks[key]
+
+
+def create_client(session, *args, **kwargs):
+    """Create a Boto3 client from a session that may be shared with other threads"""
+    with cache_lock('session', id(session)):
+        return session.client(*args, **kwargs)
+
+
 def get_session(config):
-    if config.profile_name not in _session_cache:
-        logger.info(f'Creating new Boto3 Session for profile {config.profile_name}')
-        _session_cache[config.profile_name] = boto3.Session(profile_name=config.profile_name)
+    with cache_lock('profile', config.profile_name):
+        if config.profile_name not in _session_cache:
+            logger.info(f'Creating new Boto3 Session for profile {config.profile_name}')
+            _session_cache[config.profile_name] = boto3.Session(profile_name=config.profile_name)
 
-    session = _session_cache[config.profile_name]
+        session = _session_cache[config.profile_name]
 
     if config.role_arn:
-        if config.role_arn not in _session_cache:
-            sts_client = session.client('sts')
-            role_session_name = f'{__name__}.session-{time.time()}'
-
-            logger.info(f'Assuming role {config.role_arn}')
-            assumed_role = sts_client.assume_role(RoleArn=config.role_arn,
-                                                  ExternalId=config.external_id,
-                                                  RoleSessionName=role_session_name)
-            logger.info(f'Creating new Boto3 Session for role {config.role_arn}')
-            _session_cache[config.role_arn] = boto3.Session(aws_access_key_id=assumed_role['Credentials']['AccessKeyId'],
-                                                            aws_secret_access_key=assumed_role['Credentials']['SecretAccessKey'],
-                                                            aws_session_token=assumed_role['Credentials']['SessionToken'])
+        with cache_lock('role', config.role_arn):
+            if config.role_arn not in _session_cache:
+                logger.info(f'Creating new Boto3 Session for role {config.role_arn}')
+                _session_cache[config.role_arn] = get_role_session(session, config)
 
-        session = _session_cache[config.role_arn]
+            session = _session_cache[config.role_arn]
 
     return session
 
 
-async def store_aws_metadata(config):
-    """Store AWS metadata (result of ec2.describe_instances call) into Redis"""
+def get_role_session(session, config):
+    """ Return a Boto3 Session for an assumed role
+
+    The role's credentials are refreshed automatically before they expire, so that
+    long-running syncs can outlast the role session duration. If a credential
+    cache file is configured, credentials are shared through it with other sync
+    processes, so that each run does not need to assume every role again.
+    """
+    sts_client = create_client(session, 'sts')
+    cache_key = f'{config.role_arn} {config.external_id or ""}'
+
+    def fetch_credentials():
+        credentials = load_cached_credentials(config.credential_cache, cache_key)
+        if credentials is not None:
+            logger.info(f'Using cached credentials for role {config.role_arn}')
+            return credentials
+
+        logger.info(f'Assuming role {config.role_arn}')
+        args = {'RoleArn': config.role_arn, 'RoleSessionName': f'{__name__}.session-{time.time()}'}
+        if config.external_id:
+            args['ExternalId'] = config.external_id
+        assumed_role = sts_client.assume_role(**args)['Credentials']
+        credentials = {
+            'access_key': assumed_role['AccessKeyId'],
+            'secret_key': assumed_role['SecretAccessKey'],
+            'token': assumed_role['SessionToken'],
+            'expiry_time': assumed_role['Expiration'].isoformat(),
+            'expires': assumed_role['Expiration'].timestamp(),
+        }
+        save_cached_credentials(config.credential_cache, cache_key, credentials)
+        return credentials
+
+    botocore_session = botocore.session.get_session()
+    botocore_session._credentials = RefreshableCredentials.create_from_metadata(
+        metadata=fetch_credentials(), refresh_using=fetch_credentials, method='assume-role')
+    return boto3.Session(botocore_session=botocore_session)
+
+
+def read_credential_cache(path):
+    """Return the unexpired entries in a credential cache file"""
     try:
-        session = get_session(config)
-    except botocore.exceptions.ClientError as e:
-        logger.error(f'Unable to get Boto3 Session: {e}')
-        raise SystemExit(1)
+        with open(path) as f:
+            entries = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return {key: value for key, value in entries.items() if value.get('expires', 0) > time.time()}
+
+
+def load_cached_credentials(path, key):
+    """Return credentials from a cache file, if present and not close to expiring"""
+    if not path:
+        return None
+    credentials = read_credential_cache(path).get(key)
+    if credentials is not None and credentials['expires'] - time.time() > CREDENTIAL_MIN_LIFETIME:
+        return credentials
+    return None
+
+
+def save_cached_credentials(path, key, credentials):
+    """Add credentials to a cache file, which is only readable by the current user"""
+    if not path:
+        return
+
+    # Hold a lock while merging, so that roles assumed at the same time by other threads or syncs are not dropped
+    directory = os.path.dirname(os.path.abspath(path))
+    try:
+        with _credential_cache_lock, open(os.path.join(directory, f'.{os.path.basename(path)}.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            entries = read_credential_cache(path)
+            entries[key] = credentials
+
+            # mkstemp creates the file with mode 0600, and the rename replaces the old cache atomically
+            fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.credentials-')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entries, f)
+            os.replace(temp_path, path)
+    except OSError as e:
+        logger.warning(f'Unable to write credential cache {path}: {e}')
+
+
+async def run_blocking(func, *args, **kwargs):
+    """Run a blocking function (such as a Boto3 API call) on a worker thread"""
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+
+async def paginate(client, operation, **kwargs):
+    """ Yield pages from a Boto3 paginator, fetching each page on a worker thread
+
+    Pages are fetched into a bounded queue by a separate task, so that the next
+    page is requested from AWS while the current one is being stored in Redis,
+    without holding more than a few pages in memory.
+    """
+    pages = iter(client.get_paginator(operation).paginate(**kwargs))
+    queue = asyncio.Queue(PREFETCH_PAGES)
+
+    async def fetch():
+        try:
+            while True:
+                page = await run_blocking(next, pages, None)
+                await queue.put(page)
+                if page is None:
+                    return
+        except Exception as e:
+            await queue.put(e)
+
+    fetcher = asyncio.ensure_future(fetch())
+    try:
+        while True:
+            page = await queue.get()
+            if page is None:
+                return
+            elif isinstance(page, Exception):
+                raise page
+            yield page
+    finally:
+        fetcher.cancel()
+
+
+def describe_args(filters, page_size):
+    """Return the keyword arguments for a paginated describe call with optional server-side filters"""
+    args = {'PaginationConfig': {'PageSize': page_size}}
+    if filters:
+        args['Filters'] = filters
+    return args
+
+
+async def store_aws_metadata(config, limit=None, snapshot=None):
+    """Store AWS metadata (result of ec2.describe_instances call) into Redis
+
+    Regions are synced concurrently, up to the configured parallelism for this
+    account, and to the optional global limit shared with other accounts. Returns
+    False, without syncing anything, if the account's session or regions can not
+    be found, so that other accounts synced at the same time are not interrupted.
+    """
+    try:
+        session = await run_blocking(get_session, config)
+        # Resolve the account once, rather than from every region at the same time
+        await run_blocking(get_account_id, session)
+        regions = await get_regions(session, config)
+    except Exception as e:
+        logger.error(f'Unable to get Boto3 Session for {config.name}: {e}')
+        SYNC_ERRORS.inc(config.name, config.region_name or '')
+        return False
 
-    regions = [config.region_name or session.region_name or get_instance_region()]
+    account_limit = asyncio.Semaphore(config.parallelism)
+    if limit is None:
+        limit = asyncio.Semaphore(config.parallelism)
 
-    if 'all' in regions:
-        regions = session.get_available_regions('ec2')
+    async with RedisMetadataWriter(config, snapshot) as metadata:
+        await asyncio.gather(*[store_region_metadata(session, region, metadata, account_limit, limit) for region in regions])
+    return True
 
-    async with RedisMetadataWriter(config) as metadata:
-        for region in regions:
-            logger.info(f'Describing instances in {region}')
-            try:
-                ec2_client = session.client('ec2', region)
-            except Exception as e:
-                logger.error(f'Failed to create EC2 client: {e}')
-                continue
 
-            # Store raw interfaces first so that instance interfaces can overwrite the IP lookup
-            try:
-                for interfaces in ec2_client.get_paginator('describe_network_interfaces').paginate():
-                    for interface in interfaces.get('NetworkInterfaces', []):
-                        interface = camel_dict_to_snake_dict(interface)
-                        interface['tags'] = tag_list_to_dict(interface.pop('tag_set', []))
-                        logger.info(f'Storing data for {interface["network_interface_id"]}')
-                        await metadata.store_interface(interface)
-            except Exception as e:
-                logger.error(f'Failed to sync interface information: {e}')
-                continue
+async def get_regions(session, config):
+    """Return the list of regions to sync for a configuration"""
+    regions = [config.region_name or session.region_name or await run_blocking(get_instance_region)]
+
+    if 'all' in regions:
+        regions = session.get_available_regions('ec2')
 
+    return regions
+
+
+def get_account_id(session):
+    """Return the ID of the account that a session's credentials belong to"""
+    key = id(session)
+    with cache_lock('account', key):
+        if key not in _account_cache:
+            _account_cache[key] = create_client(session, 'sts').get_caller_identity()['Account']
+        return _account_cache[key]
+
+
+def get_client(session, region):
+    """Return an EC2 client for the session and region, reusing previously created clients"""
+    key = (id(session), region)
+    with cache_lock('client', *key):
+        if key not in _client_cache:
+            _client_cache[key] = create_client(session, 'ec2', region, config=BOTO_CONFIG)
+        return _client_cache[key]
+
+
+async def store_region_metadata(session, region, metadata, account_limit, limit):
+    """ Store AWS metadata for a single region into Redis
+
+    Objects are stored with the account and region as their scope. If every
+    object was described successfully, objects that no longer exist are removed
+    and the region's known addresses are published for the listeners' filter.
+    """
+    async with account_limit, limit:
+        start = time.monotonic()
+        account = metadata.config.name
+        logger.info(f'Describing instances in {region}')
+        try:
+            ec2_client = get_client(session, region)
+            scope = f'{await run_blocking(get_account_id, session)}^{region}'
+        except Exception as e:
+            logger.error(f'Failed to create EC2 client: {e}')
+            SYNC_ERRORS.inc(account, region)
+            return
+
+        try:
+            await metadata.begin(scope)
+        except Exception as e:
+            logger.error(f'Failed to start sync of {scope}: {e}')
+            SYNC_ERRORS.inc(account, region)
+            return
+
+        # Interfaces attached to an instance are stored, but their IPs are mapped to the instance
+        try:
+            count = 0
+            args = describe_args(metadata.config.interface_filters, metadata.config.page_size)
+            async for interfaces in paginate(ec2_client, 'describe_network_interfaces', **args):
+                for interface in interfaces.get('NetworkInterfaces', []):
+                    interface = project_interface(interface)
+                    logger.info(f'Storing data for {interface["network_interface_id"]}')
+                    await metadata.store_interface(interface, scope)
+                    count += 1
+            SYNC_OBJECTS.set(count, account, region, 'interface')
+        except Exception as e:
+            logger.error(f'Failed to sync interface information: {e}')
+            SYNC_ERRORS.inc(account, region)
+            await metadata.abandon(scope)
+            return
+
+        try:
+            count = 0
+            args = describe_args(metadata.config.instance_filters, metadata.config.page_size)
+            async for instances in paginate(ec2_client, 'describe_instances', **args):
+                for reservation in instances.get('Reservations', []):
+                    for instance in reservation.get('Instances', []):
+                        instance = project_instance(instance)
+                        logger.info(f'Storing data for {instance["instance_id"]}')
+                        await metadata.store_instance(instance, scope)
+                        count += 1
+            SYNC_OBJECTS.set(count, account, region, 'instance')
+        except Exception as e:
+            logger.error(f'Failed to sync instance information: {e}')
+            SYNC_ERRORS.inc(account, region)
+            await metadata.abandon(scope)
+            return
+
+        # Store VPCs before subnets, so that a subnet covering an entire VPC takes precedence
+        try:
+            count = 0
+            async for vpcs in paginate(ec2_client, 'describe_vpcs'):
+                for vpc in vpcs.get('Vpcs', []):
+                    vpc = project_vpc(vpc)
+                    logger.info(f'Storing data for {vpc["vpc_id"]}')
+                    await metadata.store_network(vpc, scope)
+                    count += 1
+            SYNC_OBJECTS.set(count, account, region, 'vpc')
+
+            count = 0
+            async for subnets in paginate(ec2_client, 'describe_subnets'):
+                for subnet in subnets.get('Subnets', []):
+                    subnet = project_subnet(subnet)
+                    logger.info(f'Storing data for {subnet["subnet_id"]}')
+                    await metadata.store_network(subnet, scope)
+                    count += 1
+            SYNC_OBJECTS.set(count, account, region, 'subnet')
+        except Exception as e:
+            # Networks are only used for fallback matching, so hosts are still synced, with the networks from the last sync
+            logger.warning(f'Failed to sync network information; keeping previously stored networks: {e}')
+            SYNC_ERRORS.inc(account, region)
+            metadata.keep_networks(scope)
+
+        try:
+            await metadata.sweep(scope)
+        except Exception as e:
+            logger.error(f'Failed to remove objects that no longer exist: {e}')
+            SYNC_ERRORS.inc(account, region)
+            await metadata.abandon(scope)
+            return
+
+        SYNC_DURATION.set(time.monotonic() - start, account, region)
+
+
+async def run_daemon(configs, limit, snapshot=None):
+    """Keep metadata for all configured accounts and regions fresh, syncing each on its own schedule"""
+    tasks = []
+    writers = []
+    try:
+        for config in configs:
+            metadata = RedisMetadataWriter(config, snapshot)
+            writers.append(await metadata.__aenter__())
+            tasks.append(schedule_account_metadata(config, metadata, limit))
+        if snapshot is not None:
+            tasks.append(schedule_snapshot(snapshot))
+
+        await asyncio.gather(*tasks)
+    finally:
+        for metadata in writers:
+            await metadata.__aexit__(None, None, None)
+
+
+async def schedule_snapshot(snapshot):
+    """ Periodically write the snapshot if any region has been synced since it was last written
+
+    Writes are coalesced, rather than made after every region, and merging and
+    writing the file is done on a worker thread so that syncs are not held up.
+    """
+    while True:
+        await asyncio.sleep(SNAPSHOT_INTERVAL)
+        if snapshot.dirty:
             try:
-                for instances in ec2_client.get_paginator('describe_instances').paginate():
-                    for reservation in instances.get('Reservations', []):
-                        for instance in reservation.get('Instances', []):
-                            instance = camel_dict_to_snake_dict(instance)
-                            instance['tags'] = tag_list_to_dict(instance.get('tags', []))
-                            logger.info(f'Storing data for {instance["instance_id"]}')
-                            await metadata.store_instance(instance)
+                await run_blocking(snapshot.save, *snapshot.collect())
             except Exception as e:
-                logger.error(f'Failed to sync instance information: {e}')
-                continue
+                logger.error(f'Failed to write snapshot {snapshot.path}: {e}')
+                snapshot.dirty = True
+
+
+async def schedule_account_metadata(config, metadata, limit):
+    """ Sync each region of an account on its own schedule
+
+    The account's session and regions are discovered here rather than at startup,
+    so that an account whose credentials or regions cannot be found at first is
+    retried every interval, instead of being left out until the daemon restarts.
+    """
+    interval = config.interval
+    if interval > int(config.redis_ttl) * MAX_INTERVAL_RATIO:
+        interval = int(config.redis_ttl) * MAX_INTERVAL_RATIO
+        logger.warning(f'Sync interval for {config.name} is too close to metadata TTL; using {interval:.0f} seconds')
+
+    while True:
+        try:
+            session = await run_blocking(get_session, config)
+            await run_blocking(get_account_id, session)
+            regions = await get_regions(session, config)
+            break
+        except Exception as e:
+            logger.error(f'Unable to get Boto3 Session for {config.name}; retrying in {interval:.0f} seconds: {e}')
+            SYNC_ERRORS.inc(config.name, config.region_name or '')
+            await asyncio.sleep(interval * random.uniform(1 - INTERVAL_JITTER, 1 + INTERVAL_JITTER))
+
+    account_limit = asyncio.Semaphore(config.parallelism)
+    await asyncio.gather(*[schedule_region_metadata(config, session, region, interval, metadata, account_limit, limit)
+                           for region in regions])
+
+
+async def schedule_region_metadata(config, session, region, interval, metadata, account_limit, limit):
+    """Repeatedly sync a single region, at a jittered interval that refreshes metadata before it expires"""
+    # Stagger the initial sync so that targets do not all hit the API at once
+    await asyncio.sleep(random.uniform(0, interval * INTERVAL_JITTER))
+
+    while True:
+        start = time.monotonic()
+        await store_region_metadata(session, region, metadata, account_limit, limit)
+        try:
+            await metadata.commit()
+        except Exception as e:
+            logger.error(f'Failed to store metadata for {config.name} in {region}: {e}')
+        duration = time.monotonic() - start
+        logger.info(f'Synced {config.name} in {region} in {duration:.1f} seconds')
+
+        delay = interval * random.uniform(1 - INTERVAL_JITTER, 1 + INTERVAL_JITTER) - duration
+        await asyncio.sleep(max(delay, 0))
 
 
+@click.option(
+    '--snapshot',
+    default=None,
+    type=click.Path(dir_okay=False),
+    help='Also write host metadata to a snapshot file for use by listen.'
+)
 @click.option(
     '--debug',
     is_flag=True,
     help="Enable debug logging to STDERR."
 )
+@click.option(
+    '--parallelism',
+    default=4,
+    type=int,
+    help='Maximum number of regions to sync concurrently.'
+)
+@click.option(
+    '--page-size',
+    default=1000,
+    type=int,
+    help='Number of instances or interfaces to request from the EC2 API in each page.'
+)
+@click.option(
+    '--interface-filter',
+    multiple=True,
+    type=str,
+    help='EC2 filter (NAME=VALUE[,VALUE...]) to apply when describing network interfaces; may be repeated.'
+)
+@click.option(
+    '--instance-filter',
+    multiple=True,
+    type=str,
+    help='EC2 filter (NAME=VALUE[,VALUE...]) to apply when describing instances; may be repeated.'
+)
+@click.option(
+    '--chunk-size',
+    default=500,
+    type=int,
+    help='Number of objects to send to Redis in each pipelined write.'
+)
+@click.option(
+    '--layout',
+    default='inline',
+    type=click.Choice(LAYOUTS),
+    help='Layout of lookup keys stored in Redis; records stores each host once, and keys addresses by packed binary address.'
+)
+@click.option(
+    '--codec',
+    default='msgpack',
+    type=click.Choice(sorted(CODECS)),
+    help='Serialization format for AWS metadata stored in Redis.'
+)
 @click.option(
     '--ttl',
     default=1800,
     type=int,
     help='Time-to-live for AWS metadata stored in Redis.')
+@click.option(
+    '--cluster',
+    is_flag=True,
+    help='Redis server is a node of a Redis Cluster.'
+)
+@click.option(
+    '--service-name',
+    default='mymaster',
+    type=str,
+    help='Name of the Redis primary monitored by Sentinel.'
+)
+@click.option(
+    '--sentinel',
+    multiple=True,
+    type=str,
+    help='Sentinel address (HOST:PORT) to discover the Redis primary from; may be repeated.'
+)
 @click.option(
     '--port',
     default=6379,
@@ -172,6 +552,12 @@ async def store_aws_metadata(config):
     type=str,
     help='Redis server hostname.'
 )
+@click.option(
+    '--credential-cache',
+    default=None,
+    type=click.Path(dir_okay=False),
+    help='Cache assumed role credentials in this file, for reuse by later syncs.'
+)
 @click.option(
     '--external-id',
     default=None,
@@ -200,6 +586,7 @@ async def store_aws_metadata(config):
 def sync(**args):
     loop = asyncio.get_event_loop()
     sync_config = Config(**args)
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=sync_config.parallelism))
 
     if sync_config.debug_enabled:
         logging.basicConfig(level='DEBUG')
@@ -207,15 +594,33 @@ def sync(**args):
     else:
         logging.basicConfig(level='INFO', format='%(message)s')
 
-    loop.run_until_complete(store_aws_metadata(sync_config))
+    snapshot = SnapshotWriter(sync_config.snapshot) if sync_config.snapshot else None
+    success = loop.run_until_complete(store_aws_metadata(sync_config, snapshot=snapshot))
+    if snapshot is not None:
+        snapshot.write()
     loop.close()
 
+    if not success:
+        raise SystemExit(1)
+
 
+@click.option(
+    '--snapshot',
+    default=None,
+    type=click.Path(dir_okay=False),
+    help='Also write host metadata to a snapshot file for use by listen.'
+)
 @click.option(
     '--debug',
     is_flag=True,
     help="Enable debug logging to STDERR."
 )
+@click.option(
+    '--max-parallelism',
+    default=16,
+    type=int,
+    help='Maximum number of regions to sync concurrently across all accounts.'
+)
 @click.option(
     '--config',
     required=True,
@@ -223,8 +628,9 @@ def sync(**args):
     help='Path to configuration file describing accounts and regions to sync.'
 )
 @click.command('sync-multi', short_help='Collect EC2 inventory from multiple accounts.')
-def sync_multi(debug, config):
+def sync_multi(debug, config, max_parallelism, snapshot):
     loop = asyncio.get_event_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=max_parallelism))
 
     if debug:
         logging.basicConfig(level='DEBUG')
@@ -232,7 +638,67 @@ def sync_multi(debug, config):
     else:
         logging.basicConfig(level='INFO', format='%(message)s')
 
-    for sync_config in parse_file(config):
-        loop.run_until_complete(store_aws_metadata(sync_config))
+    limit = asyncio.Semaphore(max_parallelism)
+    snapshot = SnapshotWriter(snapshot) if snapshot else None
+    results = loop.run_until_complete(asyncio.gather(*[store_aws_metadata(sync_config, limit, snapshot) for sync_config in parse_file(config)]))
+    if snapshot is not None:
+        snapshot.write()
+
+    loop.close()
+
+    # Accounts that could not be synced have been skipped; report them once the others are done
+    if not all(results):
+        raise SystemExit(1)
+
+
+@click.option(
+    '--metrics-socket',
+    default=None,
+    type=click.Path(dir_okay=False),
+    help='Serve metrics over HTTP on a Unix socket at this path.'
+)
+@click.option(
+    '--metrics-port',
+    default=None,
+    type=int,
+    help='Serve metrics over HTTP on this port on localhost.'
+)
+@click.option(
+    '--snapshot',
+    default=None,
+    type=click.Path(dir_okay=False),
+    help='Also write host metadata to a snapshot file for use by listen.'
+)
+@click.option(
+    '--debug',
+    is_flag=True,
+    help="Enable debug logging to STDERR."
+)
+@click.option(
+    '--max-parallelism',
+    default=16,
+    type=int,
+    help='Maximum number of regions to sync concurrently across all accounts.'
+)
+@click.option(
+    '--config',
+    required=True,
+    type=click.Path(exists=True, dir_okay=False),
+    help='Path to configuration file describing accounts and regions to sync.'
+)
+@click.command('sync-daemon', short_help='Continuously collect EC2 inventory from multiple accounts.')
+def sync_daemon(debug, config, max_parallelism, snapshot, metrics_port, metrics_socket):
+    loop = asyncio.get_event_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=max_parallelism))
+
+    if debug:
+        logging.basicConfig(level='DEBUG')
+        loop.set_debug(1)
+    else:
+        logging.basicConfig(level='INFO', format='%(message)s')
 
+    limit = asyncio.Semaphore(max_parallelism)
+    snapshot = SnapshotWriter(snapshot) if snapshot else None
+    loop.run_until_complete(metrics.start_server(metrics_port, metrics_socket))
+    loop.run_until_complete(run_daemon(parse_file(config), limit, snapshot))
     loop.close()
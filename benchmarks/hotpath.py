@@ -0,0 +1,246 @@
+""" Microbenchmarks for the listen hot path: request parsing, profile decoding, ACL matching and handle_line
+
+Generates a synthetic inventory of instances (with several interfaces, security
+groups and tags each) and Lambda interfaces, along with a set of ACLs, and reports
+operations per second for each stage. Lookups are served from a snapshot file by
+default; pass --redis to sync the inventory into a Redis server and look it up
+from there instead. Results can be saved as JSON and compared against a previous
+run to see whether a change made things faster or slower.
+
+Usage: PYTHONPATH=. python benchmarks/hotpath.py [--redis HOST:PORT] [--save FILE] [--compare FILE]
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+from aws_acl_helper import aclmatch, listen, squid
+from aws_acl_helper.config import Config
+from aws_acl_helper.metadata import (MsgpackCodec, PickleCodec, RedisMetadataReader, RedisMetadataWriter, get_addresses,
+                                     project_instance, project_interface)
+from aws_acl_helper.snapshot import SnapshotMetadataReader, SnapshotWriter
+
+# Number of requests sent to handle_line at once, as Squid would with concurrency enabled
+CONCURRENCY = 100
+
+
+def make_inventory(instances=2000, lambdas=500, seed=0):
+    """Return lists of Boto3-style instance and Lambda interface documents"""
+    rng = random.Random(seed)
+    groups = [{'GroupId': f'sg-{n:08x}', 'GroupName': f'group {n}'} for n in range(200)]
+    subnets = [f'subnet-{n:08x}' for n in range(50)]
+    addresses = (f'10.{n >> 16 & 255}.{n >> 8 & 255}.{n & 255}' for n in range(1, 1 << 24))
+
+    def interface(number, subnet, attachment):
+        return {
+            'NetworkInterfaceId': f'eni-{number:08x}',
+            'Description': f'Interface {number}',
+            'OwnerId': '123456789012',
+            'SubnetId': subnet,
+            'VpcId': 'vpc-00000001',
+            'Groups': rng.sample(groups, 5),
+            'Attachment': attachment,
+            'PrivateIpAddresses': [{'PrivateIpAddress': next(addresses)} for _ in range(2)],
+            'TagSet': [{'Key': 'Name', 'Value': f'interface-{number}'}],
+        }
+
+    instance_docs = []
+    for n in range(instances):
+        instance_id = f'i-{n:08x}'
+        subnet = rng.choice(subnets)
+        instance_docs.append({
+            'InstanceId': instance_id,
+            'ImageId': f'ami-{n % 20:08x}',
+            'VpcId': 'vpc-00000001',
+            'Placement': {'AvailabilityZone': rng.choice(['us-west-2a', 'us-west-2b', 'us-west-2c'])},
+            'NetworkInterfaces': [interface(n * 4 + i, subnet, {'InstanceId': instance_id, 'InstanceOwnerId': '123456789012'})
+                                  for i in range(3)],
+            'Tags': [{'Key': 'Name', 'Value': f'host-{n}'},
+                     {'Key': 'Environment', 'Value': rng.choice(['prod', 'stage', 'dev'])},
+                     {'Key': 'Team', 'Value': f'team-{n % 30}'}],
+        })
+
+    lambda_docs = [interface((instances + n) * 4, rng.choice(subnets), {'InstanceOwnerId': 'aws-lambda'}) for n in range(lambdas)]
+    return instance_docs, lambda_docs
+
+
+def host_addresses(document):
+    """Return the addresses of a projected instance or interface document"""
+    return [address for interface in document.get('network_interfaces', [document]) for address in get_addresses(interface)]
+
+
+def make_acls(instance_docs, count=12, seed=0):
+    """Return a list of ACL argument strings of the kinds commonly used in Squid configs"""
+    rng = random.Random(seed)
+    acls = []
+    for n in range(count):
+        instance = rng.choice(instance_docs)
+        acls.append(rng.choice([
+            f'sg-{rng.randrange(200):08x} sg-{rng.randrange(200):08x}',
+            f'vpc-00000001 sg:group%20{rng.randrange(200)}',
+            f'tag:Environment=prod tag:Team=team-{rng.randrange(30)}',
+            'az:us-west-2* type:lambda',
+            f'{instance["InstanceId"]} {instance["NetworkInterfaces"][0]["NetworkInterfaceId"]}',
+            f'owner:123456789012 subnet-{rng.randrange(50):08x}',
+            'any',
+        ]))
+    return acls
+
+
+def make_lines(addresses, acls, count=20000, seed=0):
+    """Return Squid request lines with channel IDs, for random known and unknown clients"""
+    rng = random.Random(seed)
+    unknown = [f'192.168.{n >> 8}.{n & 255}' for n in range(256)]
+    lines = []
+    for n in range(count):
+        client = rng.choice(addresses) if rng.random() < 0.95 else rng.choice(unknown)
+        lines.append(f'{n % 1000} {client} {rng.choice(acls)}\n'.encode())
+    return lines
+
+
+def measure(func, number, repeat=5):
+    """Return the best rate, in operations per second, of calling func (which performs number operations)"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return number / best
+
+
+class ResponseSink(object):
+    """Stand-in for listen.ResponseBuffer that discards responses"""
+    def write(self, line):
+        pass
+
+
+def run_handle_line(loop, metadata, lines, decision_cache_size):
+    """Return a function that runs every line through listen.handle_line, CONCURRENCY requests at a time"""
+    async def run():
+        listen.decisions = listen.DecisionCache(decision_cache_size, 60)
+        for start in range(0, len(lines), CONCURRENCY):
+            await asyncio.gather(*[listen.handle_line(metadata, line) for line in lines[start:start + CONCURRENCY]])
+    return lambda: loop.run_until_complete(run())
+
+
+async def store_inventory(config, instance_docs, lambda_docs, snapshot=None, scope='benchmark'):
+    async with RedisMetadataWriter(config, snapshot) as writer:
+        await writer.begin(scope)
+        for doc in lambda_docs:
+            await writer.store_interface(project_interface(doc), scope)
+        for doc in instance_docs:
+            for interface in doc['NetworkInterfaces']:
+                await writer.store_interface(project_interface(interface), scope)
+            await writer.store_instance(project_instance(doc), scope)
+        await writer.sweep(scope)
+
+
+def run_benchmarks(args):
+    loop = asyncio.get_event_loop()
+    instance_docs, lambda_docs = make_inventory(args.instances, args.lambdas)
+    instances = [project_instance(doc) for doc in instance_docs]
+    interfaces = [project_interface(doc) for doc in lambda_docs]
+    profiles = [aclmatch.make_profile(doc) for doc in instances + interfaces]
+    addresses = [address for doc in instances + interfaces for address in host_addresses(doc)]
+    acls = make_acls(instance_docs, args.acls)
+    lines = make_lines(addresses, acls, args.requests)
+    requests = [squid.Request(line) for line in lines]
+    results = {}
+
+    # Parsing, with the helper caches cleared before each run so that only repeated tokens hit them
+    def parse():
+        squid.parse_address.cache_clear()
+        squid.parse_acl.cache_clear()
+        for line in lines:
+            squid.Request(line)
+    results['parse'] = measure(parse, len(lines))
+
+    # Profile decoding, as done for every metadata cache miss
+    for codec in (MsgpackCodec, PickleCodec):
+        encoded = [codec.encode(profile) for profile in profiles]
+        results[f'decode_{codec.__name__}'] = measure(lambda: [codec.decode(data) for data in encoded], len(encoded))
+
+    # ACL matching, both per-entry and with the compiled matcher reused across requests
+    rng = random.Random(0)
+    pairs = [(request.acl, rng.choice(profiles)) for request in requests]
+    results['check_acl_entry'] = measure(lambda: [aclmatch.check_acl_entry(acl[0], profile) for acl, profile in pairs], len(pairs))
+    results['match'] = measure(lambda: [aclmatch.compile_acl(acl).match(profile) for acl, profile in pairs], len(pairs))
+
+    # End-to-end request handling against a populated snapshot or Redis server
+    listen.responses = ResponseSink()
+    with tempfile.TemporaryDirectory() as directory:
+        snapshot_path = os.path.join(directory, 'snapshot')
+        if args.redis:
+            host, _, port = args.redis.partition(':')
+            config = Config(host=host, port=int(port or 6379))
+            loop.run_until_complete(store_inventory(config, instance_docs, lambda_docs))
+            reader = RedisMetadataReader(config)
+        else:
+            snapshot = SnapshotWriter(snapshot_path)
+            for doc, profile in zip(instances + interfaces, profiles):
+                snapshot.add(profile, host_addresses(doc), 3600)
+            snapshot.write()
+            config = Config(snapshot=snapshot_path)
+            reader = SnapshotMetadataReader(config)
+
+        metadata = loop.run_until_complete(reader.__aenter__())
+        try:
+            metadata.cache.maxsize = 0
+            results['handle_line_uncached'] = measure(run_handle_line(loop, metadata, lines, 0), len(lines), repeat=3)
+            metadata.cache.maxsize = config.cache_size
+            results['handle_line'] = measure(run_handle_line(loop, metadata, lines, config.decision_cache_size), len(lines), repeat=3)
+        finally:
+            loop.run_until_complete(reader.__aexit__(None, None, None))
+
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the aws-acl-helper listen hot path.')
+    parser.add_argument('--instances', type=int, default=2000, help='Number of synthetic EC2 instances.')
+    parser.add_argument('--lambdas', type=int, default=500, help='Number of synthetic Lambda interfaces.')
+    parser.add_argument('--acls', type=int, default=12, help='Number of distinct ACLs.')
+    parser.add_argument('--requests', type=int, default=20000, help='Number of request lines per run.')
+    parser.add_argument('--redis', default=None, help='Sync the inventory into this Redis server (HOST:PORT) and look it up from there.')
+    parser.add_argument('--save', default=None, help='Write results to this JSON file.')
+    parser.add_argument('--compare', default=None, help='Compare results against a JSON file written by --save.')
+    parser.add_argument('--min-rate', type=float, default=None, help='Exit with an error if handle_line is slower than this many requests per second.')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args)
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print(f'Comparing against {baseline.get("revision")} ({args.compare})')
+
+    for name, rate in results.items():
+        line = f'{name:24} {rate:14,.0f} ops/sec'
+        if name in baseline.get('results', {}):
+            line += f'  {rate / baseline["results"][name]:6.2f}x'
+        print(line)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'revision': git_revision(), 'python': sys.version.split()[0], 'args': vars(args), 'results': results}, f, indent=2)
+
+    if args.min_rate and results['handle_line'] < args.min_rate:
+        print(f'handle_line rate {results["handle_line"]:,.0f} is below the budget of {args.min_rate:,.0f} requests per second')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
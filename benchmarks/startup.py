@@ -0,0 +1,72 @@
+""" Check that a listen helper starts quickly and without loading modules it does not need
+
+Squid starts and restarts helper children on demand, so requests wait for each new
+listener to start. This starts `aws-acl-helper listen` against an empty snapshot,
+sends a single request, and fails if the response takes longer than the budget or
+if the AWS SDK or pkg_resources were imported along the way.
+
+Usage: PYTHONPATH=. python benchmarks/startup.py [--budget SECONDS] [--repeat N]
+"""
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+COMMAND = [sys.executable, '-m', 'aws_acl_helper.commands', 'listen']
+
+# Modules that the listener should never need to import
+FORBIDDEN_MODULES = ('boto3', 'botocore', 'pkg_resources')
+
+CHECK_IMPORTS = f"""
+import sys
+from aws_acl_helper.commands import cli
+cli.get_command(None, 'listen')
+print(' '.join(m for m in {FORBIDDEN_MODULES!r} if m in sys.modules))
+"""
+
+
+def time_to_first_response(snapshot):
+    """Start a listener and return the number of seconds until it answers a request"""
+    # Squid passes helpers a single socket as both stdin and stdout
+    squid, helper = socket.socketpair()
+    start = time.perf_counter()
+    process = subprocess.Popen(COMMAND + ['--snapshot', snapshot], stdin=helper, stdout=helper)
+    helper.close()
+    try:
+        squid.sendall(b'0 10.0.0.1 any\n')
+        response = squid.makefile('rb').readline()
+        elapsed = time.perf_counter() - start
+    finally:
+        squid.shutdown(socket.SHUT_WR)
+        process.wait(10)
+        squid.close()
+
+    if not response.startswith(b'0 '):
+        raise SystemExit(f'Unexpected response from listener: {response!r}')
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check aws-acl-helper listen startup time.')
+    parser.add_argument('--budget', type=float, default=1.0, help='Maximum number of seconds for a listener to answer its first request.')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of listeners to start; the fastest is compared to the budget.')
+    args = parser.parse_args()
+
+    imported = subprocess.check_output([sys.executable, '-c', CHECK_IMPORTS]).decode().split()
+    if imported:
+        raise SystemExit(f'listen imports modules it does not need: {", ".join(imported)}')
+
+    with tempfile.TemporaryDirectory() as directory:
+        snapshot = os.path.join(directory, 'missing')
+        elapsed = min(time_to_first_response(snapshot) for _ in range(args.repeat))
+
+    print(f'listen answered its first request in {elapsed * 1000:.0f}ms (budget {args.budget * 1000:.0f}ms)')
+    if elapsed > args.budget:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()